@@ -6,31 +6,24 @@
 #	2013-10-09	Created by Pascal Pfiffner
 #
 
-import uuid
 import string
 import logging
 from datetime import datetime
 
+from nlp import normalized_text_digest
+
 
 class Analyzable (object):
 	""" Representing a codifiable object property. """
 	
 	
 	def __init__(self, obj, keypath):
-		self._uuid = None
 		self.object = obj
 		self.keypath = keypath
 		self._waiting_for_nlp = set()		# set of NLP engine names to be run
 		self.codified = None				# dictionary with codes and dates per NLP name
 	
 	
-	@property
-	def uuid(self):
-		if not self._uuid:
-			self._uuid = uuid.uuid4()
-		return self._uuid
-	
-	
 	def waiting_for_nlp(self, nlp_name):
 		return nlp_name in self._waiting_for_nlp
 	
@@ -73,23 +66,35 @@ class Analyzable (object):
 	
 	
 	# -------------------------------------------------------------------------- Codifying
-	def codify(self, nlp_engines, force=False):
+	def codify(self, nlp_engines, force=False, callback=None):
 		""" Handle codification by the given nlp_engines, instances of
 		NLPProcessing and its subclasses.
 		
+		Engines that are streaming get our text submitted if "callback" is
+		given; it will be called with the receiver and the engine name once
+		that engine's output has been parsed.
+		
 		Returns a dictionary "nlp: codes" for the newly codified NLP pipelines.
 		"""
 		
 		all_new = {}
 		for nlp in nlp_engines:
 			if force or not self.codified or not self.codified.get(nlp.name):
-				if self.parse_nlp_output(nlp):
+				if self.parse_nlp_output(nlp) or (not force and self.codify_from_cache(nlp)):
 					all_new[nlp.name] = self.codified.get(nlp.name)
+				elif nlp.streaming and callback is not None:
+					self.submit_nlp_input(nlp, callback)
 				else:
 					self.write_nlp_input(nlp)
 		
 		return all_new if len(all_new) > 0 else None
 	
+	def nlp_filename(self, text):
+		""" NLP input and output files are named after the normalized text,
+		so analyzables with identical texts share them and the text only goes
+		through the pipeline once. """
+		return '%s.txt' % normalized_text_digest(text)
+	
 	def write_nlp_input(self, nlp_engine):
 		""" Get the string we want to analyze and tells the NLP engine to write
 		it to their input file. """
@@ -99,19 +104,75 @@ class Analyzable (object):
 			return
 		
 		# write to file and set waiting flag
-		if nlp_engine.write_input(unicode(text), '%s.txt' % self.uuid):
+		if nlp_engine.write_input(unicode(text), self.nlp_filename(text)):
 			self._waiting_for_nlp.add(nlp_engine.name)
 	
+	def submit_nlp_input(self, nlp_engine, callback):
+		""" Like "write_nlp_input" but for streaming NLP engines: parses the
+		output once the engine has processed our text and calls the callback.
+		"""
+		
+		text = self.extract_string()
+		if text is None or 0 == len(text):
+			return
+		
+		def did_process(engine):
+			if self.parse_nlp_output(engine):
+				callback(self, engine.name)
+		
+		# set the waiting flag first, the engine may call back right away
+		self._waiting_for_nlp.add(nlp_engine.name)
+		if not nlp_engine.submit(unicode(text), self.nlp_filename(text), did_process):
+			self._waiting_for_nlp.discard(nlp_engine.name)
+	
 	def parse_nlp_output(self, nlp_engine):
 		""" Returning False from this method will result in 'write_nlp_input' to
 		be called. """
 		
+		text = self.extract_string()
+		if text is None or 0 == len(text):
+			return False
+		
 		# parse our file; if it doesn't return a result we'll return False
-		filename = '%s.txt' % self.uuid
-		ret = nlp_engine.parse_output(filename, filter_sources=True)
+		ret = nlp_engine.parse_output(self.nlp_filename(text), filter_sources=True)
+		if ret is None:
+			return False
+		
+		# remember for identical texts
+		if nlp_engine.cache is not None:
+			try:
+				nlp_engine.cache.set(unicode(text), nlp_engine.name, nlp_engine.version, ret)
+			except Exception as e:
+				logging.warning("Failed to write to the NLP cache: %s" % e)
+		
+		self._did_get_nlp_result(nlp_engine, ret)
+		return True
+	
+	def codify_from_cache(self, nlp_engine):
+		""" Uses the NLP engine's cached result for our text, if it has a
+		cache and there is one. Returns True on a cache hit. """
+		if nlp_engine.cache is None:
+			return False
+		
+		text = self.extract_string()
+		if text is None or 0 == len(text):
+			return False
+		
+		try:
+			ret = nlp_engine.cache.get(unicode(text), nlp_engine.name, nlp_engine.version)
+		except Exception as e:
+			logging.warning("Failed to read from the NLP cache: %s" % e)
+			return False
 		if ret is None:
 			return False
 		
+		self._did_get_nlp_result(nlp_engine, ret)
+		return True
+	
+	def _did_get_nlp_result(self, nlp_engine, ret):
+		""" Remembers the codes in "ret", the dictionary returned by the NLP
+		engine's "parse_output()". """
+		
 		# remember codified data -- "ret" should be a dictionary
 		result_all = self.codified or {}
 		result = result_all.get(nlp_engine.name, {})
@@ -131,8 +192,6 @@ class Analyzable (object):
 		# end
 		if self._waiting_for_nlp and nlp_engine.name in self._waiting_for_nlp:
 			self._waiting_for_nlp.remove(nlp_engine.name)
-		
-		return True
 
 
 def _analyzable_objects_at_keypath(obj, keypath):
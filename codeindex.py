@@ -0,0 +1,163 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#	Read-only, memory-mapped index files for code lookups
+#
+#	2026-10-16	Created
+#
+
+import os
+import sys
+import mmap
+import json
+import struct
+import logging
+from array import array
+
+
+class CodeIndex (object):
+	""" A sorted key file mapping codes to JSON values, searched with binary
+	search over a memory map. Processes opening the same index share its
+	pages through the OS page cache.
+	
+	File layout, integers are unsigned 32 bit little endian:
+	- the magic "CODEIDX1"
+	- the number of records N
+	- N offsets of the records, relative to the first record
+	- N records "key<TAB>json<LF>", sorted by their UTF-8 encoded key
+	"""
+	
+	magic = 'CODEIDX1'
+	
+	def __init__(self, path):
+		if path is None:
+			raise Exception('No index file provided')
+		
+		self.path = path
+		self._handle = None
+		self._map = None
+		self._count = 0
+		self._records_start = 0
+	
+	def open(self):
+		if self._map is not None:
+			return
+		
+		self._handle = open(self.path, 'rb')
+		self._map = mmap.mmap(self._handle.fileno(), 0, access=mmap.ACCESS_READ)
+		if self.magic != self._map[:8]:
+			self.close()
+			raise Exception("%s is not a code index file" % self.path)
+		
+		self._count = struct.unpack('<I', self._map[8:12])[0]
+		self._records_start = 12 + 4 * self._count
+	
+	def close(self):
+		if self._map is not None:
+			self._map.close()
+			self._map = None
+		if self._handle is not None:
+			self._handle.close()
+			self._handle = None
+	
+	def __len__(self):
+		self.open()
+		return self._count
+	
+	
+	# -------------------------------------------------------------------------- Lookup
+	def get(self, key, default=None):
+		""" Returns the value stored for the key, or "default". """
+		self.open()
+		if isinstance(key, unicode):
+			key = key.encode('utf-8')
+		else:
+			key = str(key)
+		
+		low = 0
+		high = self._count
+		while low < high:
+			mid = (low + high) // 2
+			start = self._record_start(mid)
+			tab = self._map.find('\t', start)
+			mid_key = self._map[start:tab]
+			
+			if mid_key < key:
+				low = mid + 1
+			elif mid_key > key:
+				high = mid
+			else:
+				end = self._map.find('\n', tab)
+				return json.loads(self._map[tab+1:end])
+		
+		return default
+	
+	def get_many(self, keys):
+		""" Returns a dictionary of key: value for the keys that are present. """
+		found = {}
+		for key in keys:
+			value = self.get(key)
+			if value is not None:
+				found[key] = value
+		return found
+	
+	def __contains__(self, key):
+		return self.get(key) is not None
+	
+	def _record_start(self, i):
+		pos = 12 + 4 * i
+		return self._records_start + struct.unpack('<I', self._map[pos:pos+4])[0]
+	
+	
+	# -------------------------------------------------------------------------- Building
+	@classmethod
+	def build(cls, path, items):
+		""" Writes an index file from an iterable of (key, value) tuples that
+		is sorted by key, values must be JSON-serializable. Keys appearing
+		more than once keep their first value. Returns the number of records.
+		"""
+		records_path = '%s.records' % path
+		offsets = array('I') if 4 == array('I').itemsize else array('L')
+		last_key = None
+		offset = 0
+		
+		with open(records_path, 'wb') as records:
+			for key, value in items:
+				key = key.encode('utf-8') if isinstance(key, unicode) else str(key)
+				if '\t' in key or '\n' in key:
+					raise Exception("Keys must not contain tabs or newlines: %r" % key)
+				if last_key is not None:
+					if key < last_key:
+						raise Exception("Keys must be sorted, %r came after %r" % (key, last_key))
+					if key == last_key:
+						continue
+				
+				record = '%s\t%s\n' % (key, json.dumps(value, separators=(',', ':')))
+				if offset > 0xffffffff:
+					raise Exception("Index files are limited to 4 GB of records")
+				offsets.append(offset)
+				records.write(record)
+				offset += len(record)
+				last_key = key
+		
+		# header and offsets, then the records
+		tmp_path = '%s.tmp' % path
+		with open(tmp_path, 'wb') as handle:
+			handle.write(cls.magic)
+			handle.write(struct.pack('<I', len(offsets)))
+			if 'big' == sys.byteorder:
+				offsets.byteswap()
+			offsets.tofile(handle)
+			
+			with open(records_path, 'rb') as records:
+				while True:
+					chunk = records.read(1024 * 1024)
+					if not chunk:
+						break
+					handle.write(chunk)
+		
+		os.remove(records_path)
+		os.rename(tmp_path, path)
+		logging.debug("Wrote %d records to %s" % (len(offsets), path))
+		
+		return len(offsets)
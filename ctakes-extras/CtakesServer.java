@@ -0,0 +1,154 @@
+import java.io.BufferedInputStream;
+import java.io.BufferedOutputStream;
+import java.io.ByteArrayOutputStream;
+import java.io.DataInputStream;
+import java.io.DataOutputStream;
+import java.io.EOFException;
+import java.net.InetAddress;
+import java.net.ServerSocket;
+import java.net.Socket;
+import java.util.ArrayList;
+import java.util.List;
+
+import org.apache.uima.UIMAFramework;
+import org.apache.uima.analysis_engine.AnalysisEngine;
+import org.apache.uima.analysis_engine.AnalysisEngineDescription;
+import org.apache.uima.cas.CAS;
+import org.apache.uima.cas.impl.XmiCasSerializer;
+import org.apache.uima.collection.metadata.CpeCasProcessor;
+import org.apache.uima.collection.metadata.CpeDescription;
+import org.apache.uima.resource.ResourceManager;
+import org.apache.uima.resource.ResourceSpecifier;
+import org.apache.uima.resource.metadata.ProcessingResourceMetaData;
+import org.apache.uima.util.CasCreationUtils;
+import org.apache.uima.util.InvalidXMLException;
+import org.apache.uima.util.XMLInputSource;
+import org.apache.uima.util.XMLParser;
+
+
+/**
+ *  Keeps one cTAKES analysis engine loaded and processes documents sent over a
+ *  local socket, answering with the XMI of the processed CAS.
+ *
+ *  Requests and responses are a 4-byte big-endian length followed by that many
+ *  bytes of UTF-8. An empty request is a health check and answered with "OK".
+ *  A negative response length signals an error, the message follows.
+ *
+ *  The descriptor can be a CPE descriptor, like the "FilesToXmi.xml" that
+ *  run.sh uses, in which case its analysis engines are run in order and its
+ *  collection reader and CAS consumers are ignored. This way server and batch
+ *  mode produce the same annotations. An analysis engine descriptor works too.
+ *
+ *  Usage: java CtakesServer [port] [descriptor]
+ */
+public class CtakesServer
+{
+	public static void main(String[] args) throws Exception
+	{
+		int port = (args.length > 0) ? Integer.parseInt(args[0]) : 9871;
+		String descriptor = (args.length > 1) ? args[1] : "FilesToXmi.xml";
+
+		// load the pipeline, this is what takes minutes
+		List<AnalysisEngine> engines = loadEngines(descriptor);
+		List<ProcessingResourceMetaData> metaData = new ArrayList<ProcessingResourceMetaData>();
+		for (AnalysisEngine engine : engines) {
+			metaData.add(engine.getProcessingResourceMetaData());
+		}
+		CAS cas = CasCreationUtils.createCas(metaData);
+
+		// serve one client at a time, the engine is not thread-safe anyway
+		ServerSocket server = new ServerSocket(port, 50, InetAddress.getByName("127.0.0.1"));
+		System.out.println("cTAKES server listening on port " + port);
+		while (true) {
+			Socket client = server.accept();
+			try {
+				handle(client, engines, cas);
+			}
+			catch (Exception e) {
+				System.err.println("Error handling client: " + e);
+			}
+			finally {
+				client.close();
+			}
+		}
+	}
+
+	private static List<AnalysisEngine> loadEngines(String descriptor) throws Exception
+	{
+		XMLParser parser = UIMAFramework.getXMLParser();
+		List<AnalysisEngine> engines = new ArrayList<AnalysisEngine>();
+
+		// a CPE descriptor, use its analysis engines
+		CpeDescription cpe = null;
+		try {
+			cpe = parser.parseCpeDescription(new XMLInputSource(descriptor));
+		}
+		catch (InvalidXMLException e) {
+			cpe = null;
+		}
+		if (null != cpe) {
+			ResourceManager manager = UIMAFramework.newDefaultResourceManager();
+			for (CpeCasProcessor processor : cpe.getCpeCasProcessors().getAllCpeCasProcessors()) {
+				ResourceSpecifier spec = parser.parseResourceSpecifier(new XMLInputSource(processor.getCpeComponentDescriptor().findAbsoluteUrl(manager)));
+				if (spec instanceof AnalysisEngineDescription) {
+					engines.add(UIMAFramework.produceAnalysisEngine(spec));
+				}
+			}
+			if (engines.isEmpty()) {
+				throw new Exception("The CPE descriptor " + descriptor + " does not contain any analysis engines");
+			}
+			return engines;
+		}
+
+		// an analysis engine descriptor
+		engines.add(UIMAFramework.produceAnalysisEngine(parser.parseResourceSpecifier(new XMLInputSource(descriptor))));
+		return engines;
+	}
+
+	private static void handle(Socket client, List<AnalysisEngine> engines, CAS cas) throws Exception
+	{
+		DataInputStream in = new DataInputStream(new BufferedInputStream(client.getInputStream()));
+		DataOutputStream out = new DataOutputStream(new BufferedOutputStream(client.getOutputStream()));
+
+		while (true) {
+			int length;
+			try {
+				length = in.readInt();
+			}
+			catch (EOFException e) {
+				return;
+			}
+			byte[] request = new byte[length];
+			in.readFully(request);
+
+			// health check
+			if (0 == length) {
+				write(out, "OK".getBytes("UTF-8"), false);
+				continue;
+			}
+
+			// process
+			try {
+				cas.reset();
+				cas.setDocumentText(new String(request, "UTF-8"));
+				for (AnalysisEngine engine : engines) {
+					engine.process(cas);
+				}
+
+				ByteArrayOutputStream xmi = new ByteArrayOutputStream();
+				XmiCasSerializer.serialize(cas, xmi);
+				write(out, xmi.toByteArray(), false);
+			}
+			catch (Exception e) {
+				write(out, String.valueOf(e).getBytes("UTF-8"), true);
+			}
+		}
+	}
+
+	private static void write(DataOutputStream out, byte[] data, boolean isError) throws Exception
+	{
+		out.writeInt(isError ? -data.length : data.length);
+		out.write(data);
+		out.flush();
+	}
+}
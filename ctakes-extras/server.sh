@@ -0,0 +1,35 @@
+#!/bin/sh
+#
+# Starts a long-running cTAKES server, see CtakesServer.java.
+# Requires JAVA JDK 1.6+
+#
+# Usage: server.sh [port] [descriptor, defaults to FilesToXmi.xml like run.sh]
+
+# source UMLS credentials
+if [ ! -f ./umls.sh ]; then
+  echo "You need to provide UMLS credentials in the file ./umls.sh" >&2
+  exit 1
+fi
+. ./umls.sh
+
+# only set CTAKES_HOME if not already set
+[ -z "$CTAKES_HOME" ] && CTAKES_HOME=$(dirname $0)
+cd $CTAKES_HOME
+
+CP=$CTAKES_HOME:$CTAKES_HOME/lib/*:$CTAKES_HOME/desc/:$CTAKES_HOME/resources/
+
+# compile the server if needed
+if [ ! -e CtakesServer.class ] || [ CtakesServer.java -nt CtakesServer.class ]; then
+	javac -cp "$CP" CtakesServer.java
+	if [ 0 -ne $? ]; then
+		echo "Failed to compile CtakesServer.java" >&2
+		exit 1
+	fi
+fi
+
+# launch
+exec java -cp "$CP" \
+	-Dlog4j.configuration=file:$CTAKES_HOME/config/log4j.xml \
+	-Dctakes.umlsuser=$UMLS_USERNAME -Dctakes.umlspw=$UMLS_PASSWORD \
+	-Xms512M -Xmx1024M \
+	CtakesServer $@
@@ -7,12 +7,18 @@
 #
 
 import os
+import time
+import socket
+import struct
 import logging
 import codecs
 import inspect
 
-from xml.dom.minidom import parse
-from subprocess import call
+try:
+	import xml.etree.cElementTree as ET
+except ImportError:
+	import xml.etree.ElementTree as ET
+from subprocess import call, Popen
 
 from nlp import NLPProcessing, list_to_sentences
 
@@ -24,7 +30,27 @@ class cTAKES (NLPProcessing):
 		super(cTAKES, self).__init__()
 		self.name = 'ctakes'
 		self.bin = os.path.dirname(os.path.abspath('%s/../' % inspect.getfile(inspect.currentframe())))
+		self.version = '3.1.0'
+		self.memory_estimate = 1024		# MB, the JVM runs with -Xmx1024M
+		
+		# server mode: keep one JVM running instead of launching one per run
+		self.use_server = False
+		self.server_port = 9871
+		self.server_startup_timeout = 900	# seconds, loading dictionaries and models takes a while
+		self.server_timeout = 300			# seconds per document
+		self._server_process = None
+		self._server_socket = None
+	
+	def prepare_for_worker(self):
+		""" The server process and its socket belong to the parent. """
+		super(cTAKES, self).prepare_for_worker()
+		self._server_process = None
+		self._server_socket = None
+	
 	
+	@property
+	def supports_streaming(self):
+		return self.use_server
 	
 	@property
 	def _in_dir(self):
@@ -42,10 +68,114 @@ class cTAKES (NLPProcessing):
 		if not os.path.exists(out_dir):
 			os.mkdir(out_dir)
 	
-	def _run(self):
-		if call(['%s/ctakes/run.sh' % self.bin, self.root]) > 0:
+	def _run(self, filenames=None):
+		if self.use_server:
+			self._run_with_server(filenames)
+		elif call(['%s/ctakes/run.sh' % self.bin, self.root]) > 0:
 			raise Exception('Error running cTakes')
 	
+	
+	# -------------------------------------------------------------------------- Server Mode
+	def _run_with_server(self, filenames=None):
+		""" Sends the given input files, or all of them, that have no output
+		yet to our cTAKES server and writes the XMI it returns to the output
+		directory, just like the CPE run by "run.sh" does. """
+		in_dir = self._in_dir
+		out_dir = self._out_dir
+		
+		try:
+			for filename in (filenames if filenames is not None else os.listdir(in_dir)):
+				outfile = os.path.join(out_dir, '%s.xmi' % filename)
+				if os.path.exists(outfile):
+					continue
+				
+				with codecs.open(os.path.join(in_dir, filename), 'r', 'utf-8') as handle:
+					text = handle.read()
+				
+				# the server takes an empty request for a health check
+				if 0 == len(text.strip()):
+					logging.warning("Skipping empty cTAKES input %s" % filename)
+					continue
+				
+				# the server logged its error, skip the document
+				xmi = self._server_request(text.encode('utf-8'))
+				if xmi is None:
+					logging.warning("No cTAKES output for %s" % filename)
+					continue
+				with open(outfile, 'wb') as handle:
+					handle.write(xmi)
+		finally:
+			self._close_server_socket()
+	
+	def _server_request(self, data, may_restart=True):
+		""" Sends data to the server and returns its response, None if the
+		server failed to process it. Starts the server if it isn't running
+		and restarts it once if the connection fails. """
+		try:
+			if self._server_socket is None:
+				if not self.server_is_healthy():
+					self.start_server()
+				self._server_socket = socket.create_connection(('127.0.0.1', self.server_port), self.server_timeout)
+			return _ctakes_server_exchange(self._server_socket, data)
+		
+		except socket.error as e:
+			self._close_server_socket()
+			if not may_restart:
+				raise Exception("The cTAKES server failed: %s" % e)
+			
+			logging.warning("Connection to the cTAKES server failed (%s), restarting it" % e)
+			self.stop_server()
+			self.start_server()
+			return self._server_request(data, False)
+	
+	def _close_server_socket(self):
+		if self._server_socket is not None:
+			try:
+				self._server_socket.close()
+			except socket.error:
+				pass
+			self._server_socket = None
+	
+	def server_is_healthy(self):
+		""" Connects to the server and sends an empty request, which it must
+		answer with "OK". """
+		try:
+			sock = socket.create_connection(('127.0.0.1', self.server_port), 10)
+			try:
+				return 'OK' == _ctakes_server_exchange(sock, '')
+			finally:
+				sock.close()
+		except Exception:
+			return False
+	
+	def start_server(self):
+		""" Launches "ctakes/server.sh" and waits until the server is healthy.
+		Raises if it exits or doesn't come up in time. """
+		logging.info("Starting cTAKES server on port %d" % self.server_port)
+		self._server_process = Popen(['%s/ctakes/server.sh' % self.bin, str(self.server_port)])
+		
+		started = time.time()
+		while not self.server_is_healthy():
+			if self._server_process.poll() is not None:
+				self._server_process = None
+				raise Exception("The cTAKES server exited during startup")
+			if time.time() - started > self.server_startup_timeout:
+				self.stop_server()
+				raise Exception("The cTAKES server did not start within %d seconds" % self.server_startup_timeout)
+			time.sleep(5)
+	
+	def stop_server(self):
+		""" Terminates the server if we started it. """
+		self._close_server_socket()
+		if self._server_process is not None:
+			if self._server_process.poll() is None:
+				self._server_process.terminate()
+				self._server_process.wait()
+			self._server_process = None
+	
+	
+	# -------------------------------------------------------------------------- Input and Output
+	
 	def _write_input(self, text, filename):
 		if text is None \
 			or len(text) < 1 \
@@ -57,13 +187,13 @@ class cTAKES (NLPProcessing):
 			logging.error("The input directory for cTAKES at %s does not exist" % in_dir)
 			return False
 		
+		# an identical text has already been written
 		infile = os.path.join(in_dir, filename)
 		if os.path.exists(infile):
-			return False
+			return True
 		
 		# write it
-		with codecs.open(infile, 'w', 'utf-8') as handle:
-			handle.write(list_to_sentences(text))
+		self._write_input_file(infile, list_to_sentences(text).encode('utf-8'))
 		
 		return True
 	
@@ -86,60 +216,7 @@ class cTAKES (NLPProcessing):
 			# do not log here and silently fail
 			return None
 		
-		snomeds = []
-		cuis = []
-		rxnorms = []
-		
-		# parse XMI file
-		root = parse(outfile).documentElement
-		
-		# get all "textsem:EntityMention" which store negation information
-		neg_ids = []
-		for node in root.getElementsByTagName('textsem:EntityMention'):
-			polarity = node.attributes.get('polarity')
-			if polarity is not None and int(polarity.value) < 0:
-				ids = node.attributes.get('ontologyConceptArr')
-				if ids is not None and ids.value:
-					neg_ids.extend([int(i) for i in ids.value.split()])
-		
-		# pluck apart nodes that carry codified data ("refsem" namespace)
-		code_nodes = root.getElementsByTagNameNS('http:///org/apache/ctakes/typesystem/type/refsem.ecore', '*')
-		if len(code_nodes) > 0:
-			for node in code_nodes:
-				#print node.toprettyxml()
-				
-				# check if this node is negated
-				is_neg = False
-				node_id_attr = node.attributes.get('xmi:id')
-				if node_id_attr is not None:
-					is_neg = int(node_id_attr.value) in neg_ids
-				
-				# extract SNOMED and RxNORM
-				if 'codingScheme' in node.attributes.keys() \
-					and 'code' in node.attributes.keys():
-					code = node.attributes['code'].value
-					if is_neg:
-						code = "-%s" % code
-					
-					# extract SNOMED code
-					if 'SNOMED' == node.attributes['codingScheme'].value:
-						snomeds.append(code)
-					
-					# extract RXNORM code
-					elif 'RXNORM' == node.attributes['codingScheme'].value:
-						rxnorms.append(code)
-				
-				# extract UMLS CUI
-				if 'cui' in node.attributes.keys():
-					code = node.attributes['cui'].value
-					if is_neg:
-						code = "-%s" % code
-					cuis.append(code)
-			
-			# make lists unique
-			snomeds = list(set(snomeds))
-			cuis = list(set(cuis))
-			rxnorms = list(set(rxnorms))
+		snomeds, cuis, rxnorms = _parse_ctakes_xmi(outfile)
 		
 		# clean up if instructed to do so
 		if self.cleanup:
@@ -160,6 +237,82 @@ class cTAKES (NLPProcessing):
 		return ret
 
 
+_XMI_ID = '{http://www.omg.org/XMI}id'
+_TEXTSEM_ENTITY_MENTION = '{http:///org/apache/ctakes/typesystem/type/textsem.ecore}EntityMention'
+_REFSEM_NS = '{http:///org/apache/ctakes/typesystem/type/refsem.ecore}'
+
+def _parse_ctakes_xmi(path):
+	""" Reads SNOMED, UMLS CUI and RxNorm codes from a cTAKES XMI file in one
+	pass, discarding elements as we go. Codes of concepts referenced by a
+	negated "textsem:EntityMention" are prefixed with a minus.
+	Returns a tuple of unique (snomeds, cuis, rxnorms).
+	"""
+	neg_ids = set()
+	concepts = []		# tuples of (xmi:id, codingScheme, code, cui)
+	
+	for event, elem in ET.iterparse(path):
+		tag = elem.tag
+		
+		# "textsem:EntityMention" store negation information
+		if _TEXTSEM_ENTITY_MENTION == tag:
+			polarity = elem.get('polarity')
+			if polarity is not None and int(polarity) < 0:
+				ids = elem.get('ontologyConceptArr')
+				if ids:
+					neg_ids.update(ids.split())
+		
+		# nodes in the "refsem" namespace carry codified data; they may come
+		# before the mentions referencing them, so resolve negation at the end
+		elif tag.startswith(_REFSEM_NS):
+			concepts.append((elem.get(_XMI_ID), elem.get('codingScheme'), elem.get('code'), elem.get('cui')))
+		
+		elem.clear()
+	
+	snomeds = set()
+	cuis = set()
+	rxnorms = set()
+	for node_id, scheme, code, cui in concepts:
+		prefix = '-' if node_id is not None and node_id in neg_ids else ''
+		
+		# extract SNOMED and RxNORM
+		if scheme is not None and code is not None:
+			if 'SNOMED' == scheme:
+				snomeds.add(prefix + code)
+			elif 'RXNORM' == scheme:
+				rxnorms.add(prefix + code)
+		
+		# extract UMLS CUI
+		if cui is not None:
+			cuis.add(prefix + cui)
+	
+	return list(snomeds), list(cuis), list(rxnorms)
+
+
+def _ctakes_server_exchange(sock, data):
+	""" Sends one length-prefixed request and returns the response, see
+	"ctakes-extras/CtakesServer.java" for the protocol. Server-side errors
+	are logged and return None, the connection stays usable. """
+	sock.sendall(struct.pack('>i', len(data)) + data)
+	length = struct.unpack('>i', _recv_exactly(sock, 4))[0]
+	response = _recv_exactly(sock, abs(length))
+	if length < 0:
+		logging.error("cTAKES server error: %s" % response.decode('utf-8'))
+		return None
+	
+	return response
+
+def _recv_exactly(sock, num_bytes):
+	chunks = []
+	while num_bytes > 0:
+		chunk = sock.recv(min(num_bytes, 65536))
+		if not chunk:
+			raise socket.error("Connection closed by the cTAKES server")
+		chunks.append(chunk)
+		num_bytes -= len(chunk)
+	
+	return ''.join(chunks)
+
+
 # we can execute this file to do some testing
 if '__main__' == __name__:
 	run_dir = os.path.join(os.path.dirname(__file__), 'ctakes-test')
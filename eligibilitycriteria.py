@@ -187,11 +187,21 @@ class EligibilityCriteria (object):
 		if self.criteria is None or len(self.criteria) < 1:
 			return ''
 		
+		# look up all codes at once
+		snomed_codes = set()
+		rx_codes = set()
+		cui_codes = set()
+		for crit in self.criteria:
+			snomed_codes.update(crit.get('snomed', []))
+			rx_codes.update(crit.get('rxnorm_ctakes', []))
+			cui_codes.update(crit.get('cui_metamap', []))
+		
+		snomed = SNOMEDLookup().lookup_code_meanings(snomed_codes)
+		rxnorm = RxNormLookup().lookup_code_meanings(rx_codes, True)
+		umls = UMLSLookup().lookup_code_meanings(cui_codes, True)
+		
 		# collect criteria
 		rows = []
-		snomed = SNOMEDLookup()
-		rxnorm = RxNormLookup()
-		umls = UMLSLookup()
 		is_first = True
 		for crit in self.criteria:
 			css_class = '' if is_first else 'crit_first'
@@ -219,14 +229,14 @@ class EligibilityCriteria (object):
 						<td class="%s">%s</td>
 						<td class="%s">%s</td>
 						<td class="%s">%s</td>
-						<td class="%s">%s</td>""" % (css_class, sno, css_class, snomed.lookup_code_meaning(sno), css_class, rx, css_class, rxnorm.lookup_code_meaning(rx, True), css_class, cui, css_class, umls.lookup_code_meaning(cui, True)))
+						<td class="%s">%s</td>""" % (css_class, sno, css_class, snomed.get(sno, ''), css_class, rx, css_class, rxnorm.get(rx, ''), css_class, cui, css_class, umls.get(cui, '')))
 					else:
 						rows.append("""<td>%s</td>
 						<td>%s</td>
 						<td>%s</td>
 						<td>%s</td>
 						<td>%s</td>
-						<td>%s</td>""" % (sno, snomed.lookup_code_meaning(sno), rx, rxnorm.lookup_code_meaning(rx, True), cui, umls.lookup_code_meaning(cui, True)))
+						<td>%s</td>""" % (sno, snomed.get(sno, ''), rx, rxnorm.get(rx, ''), cui, umls.get(cui, '')))
 			
 			# no codes for this criterion
 			else:
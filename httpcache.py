@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#	On-disk cache for HTTP responses
+#
+#	2026-10-16	Created
+#
+
+import time
+import zlib
+import urllib
+import sqlite3
+
+from sqlitecache import SQLiteCache
+
+
+class HTTPCache (SQLiteCache):
+	""" Caches response bodies by URL in an SQLite database, compressed.
+	Use "key()" for requests with query parameters.
+	
+	Entries older than "ttl" seconds are treated as missing. Once the
+	compressed content exceeds "max_size" bytes, the least recently used
+	entries are evicted.
+	"""
+	
+	table = 'responses'
+	key_column = 'url'
+	columns = 'url VARCHAR PRIMARY KEY, content BLOB, size INT, stored INT, accessed INT'
+	weight_column = 'size'
+	
+	def __init__(self, database, ttl=6*3600, max_size=200*1024*1024):
+		super(HTTPCache, self).__init__(database, max_size)
+		self.ttl = ttl
+	
+	@staticmethod
+	def key(url, params=None, method='GET'):
+		""" The cache key for a request: the URL for plain GET requests,
+		otherwise the method, URL and sorted query parameters. """
+		if params:
+			items = params.items() if isinstance(params, dict) else list(params)
+			encoded = [(k, v.encode('utf-8') if isinstance(v, unicode) else v) for k, v in sorted(items)]
+			url = '%s%s%s' % (url, '&' if '?' in url else '?', urllib.urlencode(encoded, True))
+		if 'GET' != method.upper():
+			url = '%s %s' % (method.upper(), url)
+		return url
+	
+	
+	# -------------------------------------------------------------------------- Getting and Setting
+	def get(self, url):
+		""" Returns the cached content for the URL (or key) or None. """
+		res = self._select(url, ['content', 'stored'])
+		
+		if res is None or res[1] < time.time() - self.ttl:
+			if res is not None:
+				self.invalidate(url)
+			self._did_miss()
+			return None
+		
+		self._did_hit(url, res[2])
+		return zlib.decompress(str(res[0]))
+	
+	def set(self, url, content):
+		""" Stores content for the URL (or key), evicting old entries if
+		needed. """
+		if content is None:
+			return
+		
+		data = zlib.compress(content)
+		self._insert({
+			'url': url,
+			'content': sqlite3.Binary(data),
+			'size': len(data),
+			'stored': int(time.time()),
+		})
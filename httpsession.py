@@ -0,0 +1,166 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#	One shared, pooling HTTP session for all outbound requests
+#
+#	2026-10-16	Created
+#
+
+import logging
+import threading
+import requests
+requests_log = logging.getLogger("requests.packages.urllib3")
+requests_log.setLevel(logging.WARNING)
+
+from requests.adapters import HTTPAdapter
+try:
+	from requests.packages.urllib3.util.retry import Retry
+except ImportError:
+	Retry = None
+
+from httpcache import HTTPCache
+
+
+class HTTPSession (object):
+	""" Hands out a process-wide requests session that keeps connections
+	alive, limits the number of connections per host and retries failed
+	requests with exponential backoff.
+	
+	Change the class variables (or use "configure()") before the first
+	request is made, the session is created lazily.
+	"""
+	
+	pool_connections = 10		# number of hosts to keep connection pools for
+	pool_maxsize = 10			# max number of connections per host
+	timeout = 60				# seconds, for connecting and for reading
+	retries = 3					# retries on connection errors and 5xx responses
+	backoff_factor = 0.5		# sleeps 0.5, 1, 2, ... seconds between retries
+	
+	cache_db = 'databases/http_cache.db'		# None disables response caching
+	cache_ttl = 6*3600			# seconds
+	cache_max_size = 200*1024*1024	# bytes of compressed content
+	
+	_session = None
+	_cache = None
+	_lock = threading.Lock()
+	
+	
+	@classmethod
+	def configure(cls, **kwargs):
+		""" Set any of the class variables above and discard the current
+		session so the next request uses the new settings. """
+		for key, val in kwargs.iteritems():
+			if not hasattr(cls, key) or '_' == key[:1]:
+				raise Exception("Unknown HTTP session setting %s" % key)
+			setattr(cls, key, val)
+		
+		with cls._lock:
+			if cls._session is not None:
+				cls._session.close()
+			cls._session = None
+			cls._cache = None
+	
+	@classmethod
+	def session(cls):
+		""" Returns the shared requests.Session, creating it if necessary. """
+		if cls._session is None:
+			with cls._lock:
+				if cls._session is None:
+					cls._session = cls._create_session()
+		
+		return cls._session
+	
+	@classmethod
+	def _create_session(cls):
+		# once retries are exhausted, hand back the last response so callers
+		# can check "ok" instead of getting a RetryError; urllib3 versions
+		# that always raise don't retry on status codes
+		if Retry is not None:
+			try:
+				retries = Retry(
+					total=cls.retries,
+					backoff_factor=cls.backoff_factor,
+					status_forcelist=[500, 502, 503, 504],
+					raise_on_status=False
+				)
+			except TypeError:
+				retries = Retry(
+					total=cls.retries,
+					backoff_factor=cls.backoff_factor
+				)
+		else:
+			retries = cls.retries
+		
+		adapter = HTTPAdapter(
+			pool_connections=cls.pool_connections,
+			pool_maxsize=cls.pool_maxsize,
+			max_retries=retries,
+			pool_block=True
+		)
+		
+		session = requests.Session()
+		session.mount('http://', adapter)
+		session.mount('https://', adapter)
+		
+		return session
+	
+	
+	@classmethod
+	def cache(cls):
+		""" Returns the HTTPCache instance or None if caching is disabled. """
+		if cls._cache is None and cls.cache_db is not None:
+			with cls._lock:
+				if cls._cache is None:
+					cls._cache = HTTPCache(cls.cache_db, cls.cache_ttl, cls.cache_max_size)
+		
+		return cls._cache
+	
+	
+	# -------------------------------------------------------------------------- Requests
+	@classmethod
+	def get(cls, url, cached=False, **kwargs):
+		""" Performs a GET request on the shared session and returns the
+		response. Applies our default timeout unless one is given.
+		
+		If "cached" is True, a successful response body is served from and
+		stored to our on-disk cache, keyed by URL and "params"; a cache hit
+		returns a CachedResponse. Requests with headers, a body or auth are
+		not cached.
+		"""
+		cache = cls.cache() if cached else None
+		if cache is not None and any(kwargs.get(arg) for arg in ('headers', 'data', 'json', 'auth', 'cookies', 'files')):
+			cache = None
+		
+		key = HTTPCache.key(url, kwargs.get('params'))
+		if cache is not None:
+			try:
+				content = cache.get(key)
+				if content is not None:
+					logging.debug('-->  CACHED: %s' % url)
+					return CachedResponse(url, content)
+			except Exception as e:
+				logging.warning("Failed to read from the HTTP cache: %s" % e)
+				cache = None
+		
+		if 'timeout' not in kwargs:
+			kwargs['timeout'] = cls.timeout
+		res = cls.session().get(url, **kwargs)
+		
+		if cache is not None and res.ok:
+			try:
+				cache.set(key, res.content)
+			except Exception as e:
+				logging.warning("Failed to write to the HTTP cache: %s" % e)
+		
+		return res
+
+
+class CachedResponse (object):
+	""" Mimicks the parts of a requests response we use, for cache hits. """
+	
+	def __init__(self, url, content):
+		self.url = url
+		self.content = content
+		self.status_code = 200
+		self.ok = True
+		self.error = None
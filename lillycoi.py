@@ -9,11 +9,11 @@
 
 import json
 import logging
-import requests
-requests_log = logging.getLogger("requests.packages.urllib3")
-requests_log.setLevel(logging.WARNING)
+import threading
+from Queue import Queue, Empty, Full
 
 from trial import Trial
+from httpsession import HTTPSession
 
 
 class LillyCOI (object):
@@ -34,6 +34,7 @@ class LillyCOI (object):
 		self.previousPageURI = None
 		self.nextPageURI = None
 		self.totalCount = 0
+		self.concurrency = 1		# > 1 fetches the remaining pages in parallel once "totalCount" is known
 	
 
 	# -------------------------------------------------------------------------- Searching for Trials
@@ -60,18 +61,12 @@ class LillyCOI (object):
 		progress_func -- A function that may (!!!) be called with the receiver's
 			instance as the first and the progress ratio as second argument
 		"""
-		
-		if condition is None or len(condition) < 1:
-			raise Exception('You must provide a condition to search for')
-		
-		cond = condition.replace(' ', '+')
-		if recruiting is not None:
-			recr = 'open' if recruiting is True else 'closed'
-			query = 'recr:%s,cond:%s' % (recr, cond)
-		else:
-			query = 'cond:%s' % cond
-		
-		return self.search_for(query, fields, progress_func)
+		return self.search_for(self._condition_query(condition, recruiting), fields, progress_func)
+	
+	def iter_search_for_condition(self, condition, recruiting=None, fields=None, progress_func=None):
+		""" Like "search_for_condition", but returns a generator yielding the
+		trials page by page while later pages are still being fetched. """
+		return self.iter_search_for(self._condition_query(condition, recruiting), fields, progress_func)
 	
 	def search_for_term(self, term, recruiting=None, fields=None, progress_func=None):
 		""" Search trials with a generic search term.
@@ -82,18 +77,12 @@ class LillyCOI (object):
 		progress_func -- A function that may (!!!) be called with the receiver's
 			instance as the first and the progress ratio as second argument
 		"""
-		
-		if term is None or len(term) < 1:
-			raise Exception('You must provide a term to search for')
-		
-		trm = term.replace(' ', '+')
-		if recruiting is not None:
-			recr = 'open' if recruiting is True else 'closed'
-			query = 'recr:%s,term:%s' % (recr, trm)
-		else:
-			query = 'term:%s' % trm
-		
-		return self.search_for(query, fields, progress_func)
+		return self.search_for(self._term_query(term, recruiting), fields, progress_func)
+	
+	def iter_search_for_term(self, term, recruiting=None, fields=None, progress_func=None):
+		""" Like "search_for_term", but returns a generator yielding the trials
+		page by page while later pages are still being fetched. """
+		return self.iter_search_for(self._term_query(term, recruiting), fields, progress_func)
 	
 	
 	def search_for(self, query, fields=None, progress_func=None):
@@ -105,43 +94,91 @@ class LillyCOI (object):
 		if query is None:
 			raise Exception("You must provide a query parameter")
 		
-		# handle fields: if None do nothing, otherwise make sure we have basic fields
-		if fields is not None:
-			for item in ['id', 'acronym', 'brief_title', 'official_title']:
-				if item not in fields:
-					fields.append(item)
+		# only counting
+		if fields is None:
+			params = 'fields=id&limit=1&query=%s' % query
+			self.get('trials/search.json', params)
+			self.nextPageURI = None
+			if self.totalCount is not None:
+				return [None for foo in xrange(self.totalCount)]
+			return []
+		
+		return list(self.iter_search_for(query, fields, progress_func))
+	
+	def iter_search_for(self, query, fields=None, progress_func=None):
+		""" Generator performing the search for the given (already prepared)
+		query, yielding Trial instances as soon as their page has been
+		fetched. Only the pages currently being fetched are held in memory.
+		
+		We always retrieve at least the NCT-number (id), acronym, brief_title
+		and official_title, also if fields is None.
+		"""
+		if query is None:
+			raise Exception("You must provide a query parameter")
+		
+		# make sure we have basic fields
+		if fields is None:
+			fields = []
+		for item in ['id', 'acronym', 'brief_title', 'official_title']:
+			if item not in fields:
+				fields.append(item)
 		
 		# compose the URL
-		flds = 'id'
 		limit = max(5, LillyCOI.perPage)
-		loop = True
-		if fields is None or 0 == len(fields):
-			limit = 1
-			loop = False
-		else:
-			flds = ','.join(fields)
+		params = 'fields=%s&limit=%d&query=%s' % (','.join(fields), limit, query)
 		
-		params = 'fields=%s&limit=%d&query=%s' % (flds, limit, query)
+		for trial in self.get('trials/search.json', params):
+			yield trial
 		
-		# loop page after page
-		results = self.get('trials/search.json', params)
-		if loop:
+		# we know how many trials there are, fetch all remaining pages at once
+		if self.concurrency > 1 and self.nextPageURI is not None and self.totalCount > limit:
+			self.nextPageURI = None
+			base = '%s/trials/search.json?%s' % (self.__class__.baseURL, params)
+			urls = ['%s&offset=%d' % (base, offset) for offset in xrange(limit, self.totalCount, limit)]
+			
+			i = 0
+			for page in self._get_concurrently(urls):
+				i += 1
+				if progress_func is not None:
+					progress_func(self, float(i) / len(urls))
+				
+				for trial in page:
+					yield trial
+		
+		# follow "nextPageURI"
+		else:
 			i = 0
 			while self.nextPageURI is not None:
 				myNext = self.nextPageURI
 				self.nextPageURI = None					# reset here in case of error
-				results.extend(self._get(myNext))		# will set nextPageURI on success
+				page = self._get(myNext)				# will set nextPageURI on success
 				
 				i += 1
 				if progress_func is not None and self.totalCount is not None:
 					progress_func(self, float(i * limit) / self.totalCount)
 				
-		else:
-			self.nextPageURI = None
-			if self.totalCount is not None:
-				results = [None for foo in xrange(self.totalCount)]
+				for trial in page:
+					yield trial
+	
+	def _condition_query(self, condition, recruiting):
+		if condition is None or len(condition) < 1:
+			raise Exception('You must provide a condition to search for')
+		
+		cond = condition.replace(' ', '+')
+		if recruiting is not None:
+			recr = 'open' if recruiting is True else 'closed'
+			return 'recr:%s,cond:%s' % (recr, cond)
+		return 'cond:%s' % cond
+	
+	def _term_query(self, term, recruiting):
+		if term is None or len(term) < 1:
+			raise Exception('You must provide a term to search for')
 		
-		return results
+		trm = term.replace(' ', '+')
+		if recruiting is not None:
+			recr = 'open' if recruiting is True else 'closed'
+			return 'recr:%s,term:%s' % (recr, trm)
+		return 'term:%s' % trm
 	
 	
 	def num_for_condition(self, condition, recruiting=True):
@@ -169,29 +206,92 @@ class LillyCOI (object):
 
 	# the base GET grabber
 	def _get(self, url):
+		data = self._fetch(url)
+		if data is None:
+			return []
+		
+		self.previousPageURI = data.get('previousPageURI')
+		self.nextPageURI = data.get('nextPageURI')
+		if self.nextPageURI:
+			self.nextPageURI = self.nextPageURI.replace(' ', '+')	# some queries come back with a space!
+		self.totalCount = int(data.get('totalCount', 1))
+		
+		return self._trials_from(data)
+	
+	def _get_concurrently(self, urls):
+		""" Fetches the given URLs on a pool of at most `self.concurrency`
+		threads. This is a generator yielding one list of trials per URL, in
+		the order of the URLs, as soon as the respective page is available.
+		Workers block while the consumer lags behind, so only a few pages are
+		held in memory at any time. Does not touch the paging instance
+		variables.
+		"""
+		todo = Queue()
+		for idx, url in enumerate(urls):
+			todo.put((idx, url))
+		done = Queue(maxsize=self.concurrency)
+		stopped = threading.Event()
+		
+		def worker():
+			while not stopped.is_set():
+				try:
+					idx, url = todo.get_nowait()
+				except Empty:
+					return
+				try:
+					data = self._fetch(url)
+					page = self._trials_from(data) if data is not None else []
+				except Exception as e:
+					logging.error("xx>  Failed to get %s: %s" % (url, e))
+					page = []
+				
+				# wait for the consumer, unless it has gone away
+				while not stopped.is_set():
+					try:
+						done.put((idx, page), timeout=1)
+						break
+					except Full:
+						pass
+		
+		for foo in xrange(min(self.concurrency, len(urls))):
+			thread = threading.Thread(target=worker)
+			thread.daemon = True
+			thread.start()
+		
+		# hand out pages in order, buffering those arriving early
+		try:
+			waiting = {}
+			next_idx = 0
+			while next_idx < len(urls):
+				idx, trials = done.get()
+				waiting[idx] = trials
+				while next_idx in waiting:
+					yield waiting.pop(next_idx)
+					next_idx += 1
+		finally:
+			stopped.set()
+	
+	def _fetch(self, url):
+		""" GETs the URL and returns the decoded JSON, None on failure. Does
+		not alter the receiver, so is safe to be called from multiple threads.
+		"""
 		logging.debug('-->  GET: %s' % url)
 		
 		# fire it off
-		res = requests.get(url)
+		res = HTTPSession.get(url, cached=True)
 		if not res.ok:
 			logging.error("xx>  %s when getting %s: %s" % (res.status_code, url, res.error))
-			return []
+			return None
 		
 		# decode JSON
-		data = {}
 		try:
-			data = json.loads(res.content)
+			return json.loads(res.content)
 		except Exception as e:
 			logging.error("-----\n%s\n-----\n%s\n-----" % (e, res.content))
-			return []
-		
-		self.previousPageURI = data.get('previousPageURI')
-		self.nextPageURI = data.get('nextPageURI')
-		if self.nextPageURI:
-			self.nextPageURI = self.nextPageURI.replace(' ', '+')	# some queries come back with a space!
-		self.totalCount = int(data.get('totalCount', 1))
-		
-		# instantiate Trial objects
+		return None
+	
+	def _trials_from(self, data):
+		""" Instantiate Trial objects from a decoded results page. """
 		trials = []
 		for tr in data.get('results', []):
 			trial = Trial()
@@ -7,12 +7,19 @@
 #
 
 import os
+import signal
 import logging
 import codecs
 import inspect
+import threading
 import subprocess
+from Queue import Queue, Empty
 
-import xml.etree.ElementTree as ET
+try:
+	import xml.etree.cElementTree as ET
+except ImportError:
+	import xml.etree.ElementTree as ET
+from cStringIO import StringIO
 
 from nlp import NLPProcessing
 
@@ -24,8 +31,28 @@ class MetaMap (NLPProcessing):
 		super(MetaMap, self).__init__()
 		self.name = 'metamap'
 		self.bin = os.path.dirname(os.path.abspath(inspect.getfile(inspect.currentframe())))
+		self.version = '2013'
+		self.memory_estimate = 2048		# MB, including the WSD and tagger servers
+		
+		# pool mode: > 0 keeps that many MetaMap processes alive across runs
+		# and feeds them documents over stdin instead of using "run.sh"
+		self.pool_size = 0
+		self.pool_args = ['--XMLf', '--silent']
+		self.pool_timeout = 300			# seconds per document, hung workers are restarted
+		self._workers = []
+		self._started_servers = []
+	
+	def prepare_for_worker(self):
+		""" The MetaMap processes belong to the parent. """
+		super(MetaMap, self).prepare_for_worker()
+		self._workers = []
+		self._started_servers = []
 	
 	
+	@property
+	def supports_streaming(self):
+		return self.pool_size > 0
+	
 	@property
 	def _in_dir(self):
 		return os.path.join(self.root, 'metamap_input')
@@ -42,13 +69,122 @@ class MetaMap (NLPProcessing):
 		if not os.path.exists(out_dir):
 			os.mkdir(out_dir)
 	
-	def _run(self):
+	def _run(self, filenames=None):
+		if self.pool_size > 0:
+			self._run_with_pool(filenames)
+			return
+		
 		try:
 			subprocess.call(['%s/metamap/run.sh' % self.bin, self.root], stderr=subprocess.STDOUT)
 		except subprocess.CalledProcessError, e:
 			raise Exception(e.output)
 	
 	
+	# -------------------------------------------------------------------------- Worker Pool
+	def _run_with_pool(self, filenames=None):
+		""" Distributes the given input files, or all of them, that have no
+		output yet over our pool of MetaMap workers, one thread per worker, and
+		writes one XML output file per input file, like "run.sh" does. """
+		in_dir = self._in_dir
+		out_dir = self._out_dir
+		
+		todo = Queue()
+		for filename in set(filenames if filenames is not None else os.listdir(in_dir)):
+			if not os.path.exists(os.path.join(out_dir, filename)):
+				todo.put(filename)
+		if todo.empty():
+			return
+		
+		self.start_pool()
+		lock = threading.Lock()
+		alive = [len(self._workers)]
+		
+		# workers that fail to restart hand their document back; take from
+		# the queue under the lock so the other workers don't quit meanwhile
+		def work(idx):
+			while True:
+				with lock:
+					try:
+						filename = todo.get_nowait()
+					except Empty:
+						alive[0] -= 1
+						return
+				
+				with codecs.open(os.path.join(in_dir, filename), 'r', 'ascii') as handle:
+					text = handle.read()
+				
+				# restart a worker that died once, then give up on the document
+				try:
+					xml = self._workers[idx].process(text, self.pool_timeout)
+				except Exception as e:
+					logging.warning("MetaMap worker failed on %s (%s), restarting it" % (filename, e))
+					self._workers[idx].stop()
+					try:
+						self._workers[idx] = MetaMapWorker(self._executable, self.pool_args)
+					except Exception as e:
+						
+						# leave the document to the other workers; the stopped
+						# worker is replaced by "start_pool()" on the next run
+						with lock:
+							alive[0] -= 1
+							if alive[0] > 0:
+								logging.error("Failed to restart MetaMap worker, %d left: %s" % (alive[0], e))
+								todo.put(filename)
+							else:
+								logging.error("Failed to restart the last MetaMap worker, %d documents were not processed: %s" % (todo.qsize() + 1, e))
+						return
+					
+					try:
+						xml = self._workers[idx].process(text, self.pool_timeout)
+					except Exception as e:
+						logging.error("MetaMap failed to process %s: %s" % (filename, e))
+						continue
+				
+				with open(os.path.join(out_dir, filename), 'wb') as handle:
+					handle.write(xml)
+		
+		threads = []
+		for idx in xrange(len(self._workers)):
+			thread = threading.Thread(target=work, args=(idx,))
+			thread.start()
+			threads.append(thread)
+		for thread in threads:
+			thread.join()
+	
+	@property
+	def _executable(self):
+		return os.path.join(self.bin, 'metamap', 'bin', 'metamap13')
+	
+	def start_pool(self):
+		""" Makes sure the WSD and tagger servers are running and that we have
+		"pool_size" live MetaMap workers. """
+		self._start_servers()
+		
+		self._workers = [w for w in self._workers if w.is_alive()]
+		while len(self._workers) < self.pool_size:
+			self._workers.append(MetaMapWorker(self._executable, self.pool_args))
+	
+	def stop_pool(self):
+		""" Stops all workers and the servers that we started. """
+		for worker in self._workers:
+			worker.stop()
+		self._workers = []
+		
+		for ctl in self._started_servers:
+			subprocess.call([os.path.join(self.bin, 'metamap', 'bin', ctl), 'stop'])
+		self._started_servers = []
+	
+	def _start_servers(self):
+		""" Starts the servers MetaMap needs unless they are already running,
+		the same way "run.sh" does. """
+		running = subprocess.check_output(['ps', '-ax'])
+		for process, ctl in [('WSD_Server', 'wsdserverctl'), ('MedPost-SKR', 'skrmedpostctl')]:
+			if process not in running:
+				if subprocess.call([os.path.join(self.bin, 'metamap', 'bin', ctl), 'start']) > 0:
+					raise Exception("Failed to start %s" % process)
+				self._started_servers.append(ctl)
+	
+	
 	def _write_input(self, text, filename):
 		if text is None or len(text) < 1 \
 			or filename is None:
@@ -59,13 +195,13 @@ class MetaMap (NLPProcessing):
 			logging.error("The input directory for MetaMap at %s does not exist" % in_dir)
 			return False
 		
+		# an identical text has already been written
 		infile = os.path.join(in_dir, filename)
 		if os.path.exists(infile):
-			return False
+			return True
 		
 		# write it
-		with codecs.open(infile, 'w', 'ascii') as handle:
-			handle.write(text.encode('ascii', 'ignore'))
+		self._write_input_file(infile, text.encode('ascii', 'ignore'))
 		
 		return True
 	
@@ -90,67 +226,21 @@ class MetaMap (NLPProcessing):
 		if not os.path.exists(outfile):
 			return None
 		
-		with_candidates = False
 		filter_sources = 'filter_sources' in kwargs
 		
-		text_phrases = []
-		cuis = set()
-		
-		# parse XMI file
+		# parse XML file, combining all documents
 		try:
-			root = ET.parse(outfile).getroot()
+			documents = parse_metamap_xml(outfile, filter_sources)
 		except Exception as e:
 			logging.error("Failed to parse MetaMap output file %s:  %s" % (outfile, e))
 			return None
 		
-		# find utterances
-		utterances = root.findall('./MMO/Utterances/Utterance')
-		for utterance in utterances:
-			full_text = utterance.find('./UttText').text
-			text_phrases.append(full_text)
-			
-			# find phrases
-			phrases = utterance.findall('./Phrases/Phrase')
-			for phrase in phrases:
-				phrase_start = int(phrase.find('./PhraseStartPos').text)
-				phrase_length = int(phrase.find('./PhraseLength').text)
-				
-				candidates = phrase.findall('./Mappings/Mapping/MappingCandidates/Candidate')
-				
-				if with_candidates:
-					candidates.extend(phrase.findall('./Candidates/Candidate'))
-				
-				# pull out codes from all candidate nodes
-				for candidate in candidates:
-					
-					# check sources if "filter_sources" is on
-					use = True
-					if filter_sources:
-						use = False
-						srcNodes = candidate.findall('./Sources/Source')
-						
-						# only use if the code is from SNOMED or Metathesaurus
-						usable = ['SNOMEDCT', 'MTH']
-						for src in srcNodes:
-							if src.text in usable:
-								use = True
-								break
-					
-					# get CUI
-					cui = None
-					if use:
-						cuiNode = candidate.find('CandidateCUI')
-						cui = cuiNode.text if cuiNode is not None else '???'
-						
-						# check negation
-						negNode = candidate.find('Negated')
-						if 1 == int(negNode.text):
-							cui = '-%s' % cui
-					
-					# add phrase position to CUI
-					if cui is not None:
-						cui = '%s@%d+%d' % (cui, phrase_start, phrase_length)
-						cuis.add(cui)
+		text_phrases = []
+		cuis = set()
+		for document in documents:
+			if 'text' in document:
+				text_phrases.append(document['text'])
+			cuis.update(document.get('cui', []))
 		
 		# clean up if instructed to do so
 		if self.cleanup:
@@ -171,6 +261,190 @@ class MetaMap (NLPProcessing):
 		return ret
 
 
+class MetaMapWorker (object):
+	""" One long-running MetaMap process that reads documents from stdin and
+	writes one XML document per input to stdout. """
+	
+	def __init__(self, executable, args):
+		if not os.path.exists(executable):
+			raise Exception("The MetaMap executable is not present at %s, did you run the install script?" % executable)
+		
+		# in its own process group, "metamap13" is a script starting the
+		# actual MetaMap process and both need to go if it hangs
+		with open(os.devnull, 'w') as devnull:
+			self.popen = subprocess.Popen([executable] + args,
+				stdin=subprocess.PIPE,
+				stdout=subprocess.PIPE,
+				stderr=devnull,
+				preexec_fn=os.setsid)
+	
+	def is_alive(self):
+		return self.popen is not None and self.popen.poll() is None
+	
+	def process(self, text, timeout=None):
+		""" Feeds the text to MetaMap and returns the XML document it produces.
+		The text goes on one line, MetaMap only handles it properly like that
+		(see "run.sh"), followed by an empty line to end the document.
+		If MetaMap takes longer than "timeout" seconds the process is killed
+		and an exception raised, the worker must then be replaced.
+		"""
+		if not self.is_alive():
+			raise Exception("The MetaMap process is not running")
+		
+		# reading blocks, so kill a hung process to end it
+		timed_out = []
+		watchdog = None
+		if timeout:
+			watchdog = threading.Timer(timeout, self._kill, (timed_out,))
+			watchdog.daemon = True
+			watchdog.start()
+		
+		try:
+			self.popen.stdin.write('%s\n\n' % ' '.join(text.split()))
+			self.popen.stdin.flush()
+			
+			# read until the end of the document, skipping anything before it
+			for document in split_metamap_documents(iter(self.popen.stdout.readline, '')):
+				return document
+		except IOError:
+			if not timed_out:
+				raise
+		finally:
+			if watchdog is not None:
+				watchdog.cancel()
+		
+		if timed_out:
+			raise Exception("MetaMap did not finish within %d seconds" % timeout)
+		raise Exception("MetaMap exited while processing")
+	
+	def _kill(self, timed_out):
+		timed_out.append(True)
+		try:
+			os.killpg(self.popen.pid, signal.SIGKILL)
+		except OSError:
+			pass
+	
+	def stop(self):
+		if self.is_alive():
+			self.popen.stdin.close()
+			self.popen.terminate()
+			self.popen.wait()
+
+
+# ------------------------------------------------------------------------------ Parsing
+_MAPPING_CANDIDATE = ('Mappings', 'Mapping', 'MappingCandidates', 'Candidate')
+_USABLE_SOURCES = set(['SNOMEDCT', 'MTH'])
+
+def parse_metamap_xml(source, filter_sources=False):
+	""" Parses MetaMap XML output in one pass, clearing elements once they
+	have been looked at. "source" is a filename or file-like object.
+	
+	We currently only retrieve the mappings' candidates, not all candidates.
+	With "filter_sources" only codes from SNOMEDCT and MTH are reported.
+	
+	Returns a list with one dictionary per MetaMap document ("MMO" element),
+	holding its utterance text under "text" and the CUIs under "cui", in the
+	form "[-]CUI@start+length": negated CUIs are prefixed with a minus and the
+	position is the phrase's.
+	"""
+	documents = []
+	text_phrases = []
+	cuis = set()
+	phrase_cuis = []
+	phrase_start = phrase_length = 0
+	stack = []
+	
+	for event, elem in ET.iterparse(source, events=('start', 'end')):
+		if 'start' == event:
+			stack.append(elem.tag)
+			continue
+		
+		tag = stack[-1]
+		parent = stack[-2] if len(stack) > 1 else None
+		
+		if 'UttText' == tag and 'Utterance' == parent:
+			text_phrases.append(elem.text or '')
+		
+		elif 'PhraseStartPos' == tag and 'Phrase' == parent:
+			phrase_start = int(elem.text)
+		
+		elif 'PhraseLength' == tag and 'Phrase' == parent:
+			phrase_length = int(elem.text)
+		
+		elif 'Candidate' == tag and _MAPPING_CANDIDATE == tuple(stack[-4:]):
+			cui = _metamap_candidate_cui(elem, filter_sources)
+			if cui is not None:
+				phrase_cuis.append(cui)
+			elem.clear()
+		
+		# the phrase position may only be known once the phrase ends
+		elif 'Phrase' == tag:
+			for cui in phrase_cuis:
+				cuis.add('%s@%d+%d' % (cui, phrase_start, phrase_length))
+			phrase_cuis = []
+			phrase_start = phrase_length = 0
+			elem.clear()
+		
+		elif 'Utterance' == tag:
+			elem.clear()
+		
+		elif 'MMO' == tag:
+			document = {}
+			if len(text_phrases) > 0:
+				document['text'] = ''.join(text_phrases)
+			if len(cuis) > 0:
+				document['cui'] = list(cuis)
+			documents.append(document)
+			text_phrases = []
+			cuis = set()
+			elem.clear()
+		
+		stack.pop()
+	
+	return documents
+
+def _metamap_candidate_cui(candidate, filter_sources):
+	""" The candidate's CUI, prefixed with a minus if negated, or None if
+	"filter_sources" is on and the candidate is not from a usable source. """
+	if filter_sources:
+		sources = candidate.find('Sources')
+		if sources is None or not any(src.text in _USABLE_SOURCES for src in sources):
+			return None
+	
+	cui_node = candidate.find('CandidateCUI')
+	cui = cui_node.text if cui_node is not None else '???'
+	
+	neg_node = candidate.find('Negated')
+	if neg_node is not None and 1 == int(neg_node.text):
+		cui = '-%s' % cui
+	
+	return cui
+
+def split_metamap_documents(lines):
+	""" Splits a stream of MetaMap XML output consisting of several
+	concatenated XML documents, as written when feeding MetaMap more than one
+	document, into the individual documents. Lines outside of a document are
+	skipped. Yields the documents as strings. """
+	document = None
+	for line in lines:
+		if document is None:
+			if '<?xml' not in line and '<MMOs' not in line:
+				continue
+			document = []
+		
+		document.append(line)
+		if '</MMOs>' in line:
+			yield ''.join(document)
+			document = None
+
+def parse_metamap_stream(lines, filter_sources=False):
+	""" Parses concatenated MetaMap XML documents, yielding the parsed
+	documents (see "parse_metamap_xml") in order. """
+	for document in split_metamap_documents(lines):
+		for parsed in parse_metamap_xml(StringIO(document), filter_sources):
+			yield parsed
+
+
 # we can execute this file to do some testing
 if '__main__' == __name__:
 	print "-->  Testing MetaMap"
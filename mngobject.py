@@ -7,9 +7,14 @@
 #
 
 import logging
+import threading
 import collections
 
 from pymongo import MongoClient
+try:
+	from pymongo.errors import BulkWriteError
+except ImportError:
+	BulkWriteError = Exception
 
 
 class MNGObject (object):
@@ -53,6 +58,12 @@ class MNGObject (object):
 		
 		return cls._collection
 	
+	@classmethod
+	def discard_collection(cls):
+		""" Forgets the collection (and its client) so the next call to
+		"collection()" connects anew, needed in forked child processes. """
+		cls._collection = None
+	
 	@classmethod
 	def test_connection(cls):
 		""" Tests the database by inserting, retrieving and deleting a document.
@@ -107,6 +118,157 @@ class MNGObject (object):
 		return ret
 	
 	
+	# -------------------------------------------------------------------------- Bulk Writes
+	
+	# the bulk writes of the current thread by class, see "begin_bulk()"
+	_bulk_local = threading.local()
+	
+	@classmethod
+	def current_bulk(cls):
+		""" The bulk writes that stores on the current thread are queued in,
+		None if the thread is not in bulk mode. """
+		bulks = getattr(cls._bulk_local, 'bulks', None)
+		return bulks.get(cls) if bulks else None
+	
+	@classmethod
+	def _set_current_bulk(cls, bulk):
+		if not hasattr(cls._bulk_local, 'bulks'):
+			cls._bulk_local.bulks = {}
+		if bulk is None:
+			cls._bulk_local.bulks.pop(cls, None)
+		else:
+			cls._bulk_local.bulks[cls] = bulk
+	
+	@classmethod
+	def begin_bulk(cls, batch_size=500):
+		""" Start queueing calls to "store()" on instances of the receiver made
+		on the current thread, they will be written as unordered bulk
+		operations every "batch_size" documents and when calling
+		"flush_bulk()" or "end_bulk()" on the same thread.
+		"did_store()" is called once a queued document has been written.
+		Returns the bulk writes, which other threads working for the same
+		unit of work can use with "join_bulk()". """
+		bulk = cls.current_bulk()
+		if bulk is None:
+			bulk = MNGBulkWrites(batch_size)
+			cls._set_current_bulk(bulk)
+		else:
+			bulk.size = max(1, batch_size)
+		return bulk
+	
+	@classmethod
+	def join_bulk(cls, bulk):
+		""" Queue stores made on the current thread in the given bulk writes,
+		returned by "begin_bulk()" on another thread, until "leave_bulk()" is
+		called. """
+		cls._set_current_bulk(bulk)
+	
+	@classmethod
+	def leave_bulk(cls):
+		""" Stop queueing stores made on the current thread in bulk writes it
+		joined, without writing them. """
+		cls._set_current_bulk(None)
+	
+	@classmethod
+	def end_bulk(cls):
+		""" Writes pending operations and leaves bulk mode, even if writing
+		fails. Threads that joined the bulk write directly from now on. """
+		bulk = cls.current_bulk()
+		if bulk is None:
+			return
+		
+		cls._set_current_bulk(None)
+		with bulk.lock:
+			queue = bulk.queue
+			bulk.queue = None
+		cls._write_bulk(queue)
+	
+	@classmethod
+	def flush_bulk(cls):
+		""" Writes all pending operations of the current thread's bulk. """
+		bulk = cls.current_bulk()
+		if bulk is not None:
+			cls._flush_bulk(bulk)
+	
+	@classmethod
+	def _flush_bulk(cls, bulk):
+		with bulk.lock:
+			queue = bulk.queue
+			if not queue:
+				return
+			bulk.queue = collections.OrderedDict()
+		cls._write_bulk(queue)
+	
+	@classmethod
+	def _write_bulk(cls, queue):
+		""" Writes the operations to the collection and calls "did_store()" on
+		the objects that were written. Raises BulkWriteError if writing any of
+		them failed. """
+		if not queue:
+			return
+		
+		bulk = cls.collection().initialize_unordered_bulk_op()
+		objects = []
+		for doc_id, (op, content, obj) in queue.iteritems():
+			if 'save' == op:
+				bulk.find({"_id": doc_id}).upsert().replace_one(content)
+			else:
+				bulk.find({"_id": doc_id}).update_one({"$set": content})
+			objects.append(obj)
+		
+		# error indexes refer to the order in which operations were added
+		failed = set()
+		error = None
+		try:
+			bulk.execute()
+		except BulkWriteError as e:
+			failed = set(err.get('index') for err in (getattr(e, 'details', None) or {}).get('writeErrors', []))
+			logging.error("Error during bulk write of %d documents, %d failed: %s" % (len(queue), len(failed), e))
+			error = e
+		
+		for idx, obj in enumerate(objects):
+			if idx not in failed:
+				obj.did_store()
+		
+		if error is not None:
+			raise error
+	
+	def _queue_store(self, bulk, subtree=None):
+		""" Queues the save or subtree update. There is at most one operation
+		per document so the unordered bulk can't apply them out of order: a
+		pending save already references our (updated) document, subtree
+		updates for the same document are merged.
+		Returns False if the bulk ended in the meantime, which can happen
+		when storing from a thread that joined it. """
+		cls = self.__class__
+		with bulk.lock:
+			if bulk.queue is None:
+				return False
+			pending = bulk.queue.get(self.id)
+			
+			if subtree is None:
+				self.ensure_doc_id()
+				bulk.queue[self.id] = ('save', self.doc, self)
+			
+			elif pending is None:
+				bulk.queue[self.id] = ('set', dict(subtree), self)
+			
+			elif 'set' == pending[0]:
+				
+				# Mongo refuses conflicting keypaths in one $set, write the
+				# pending ones first
+				if any(_keypaths_overlap(new, old) for new in subtree for old in pending[1]):
+					cls._flush_bulk(bulk)
+					bulk.queue[self.id] = ('set', dict(subtree), self)
+				else:
+					pending[1].update(subtree)
+			
+			if len(bulk.queue) >= bulk.size:
+				cls._flush_bulk(bulk)
+		
+		return True
+	
+	
 	# -------------------------------------------------------------------------- Document Manipulation
 	def ensure_doc_id(self):
 		had_doc = True
@@ -202,19 +364,35 @@ class MNGObject (object):
 		
 		cls = self.__class__
 		
+		# in bulk mode, apply subtrees locally and queue the write
+		queued = False
+		bulk = cls.current_bulk()
+		if bulk is not None and self.id is not None \
+			and (subtree is None or self.doc is not None):
+			if subtree is not None:
+				self._apply_subtree(subtree)
+			queued = self._queue_store(bulk, subtree)
+		
+		# queued writes call "did_store()" once flushed
+		if queued:
+			return True
+		
 		# update if there's a subtree, otherwise use "save"
-		if subtree is not None:
+		elif subtree is not None:
 			if self.id is None:
 				raise Exception("No id is set, cannot update subtree %s" % subtree)
 			res = cls.collection().update({"_id": self.id}, {"$set": subtree})
-			if res is not None:
-				if res.get('err'):
-					logging.warning("Error while saving subtree: %s" % res.get('err'))
-				
-				# instead of loading again, would be nice to update self.doc
-				# appropriately
-				self.doc = None
+			if res is not None and res.get('err'):
+				logging.warning("Error while saving subtree: %s" % res.get('err'))
+			
+			# update our document the same way instead of loading it again,
+			# unless we don't have one yet
+			if self.doc is None:
 				self.load()
+			else:
+				self._apply_subtree(subtree)
+				if cls.verify_subtree_updates:
+					self._verify_subtree(subtree)
 		else:
 			self.id = cls.collection().save(self.doc, manipulate=True)
 		
@@ -222,6 +400,26 @@ class MNGObject (object):
 		
 		return True
 	
+	# set to True to compare subtree updates against the database, which costs
+	# one read per write and is meant for debugging
+	verify_subtree_updates = False
+	
+	def _apply_subtree(self, subtree):
+		""" Applies a {'keypath': value} dict to our in-memory document the
+		way Mongo's "$set" does, which keeps None values as null. """
+		for keypath, value in subtree.iteritems():
+			self.doc = _setValueAtKeypath(self.doc, keypath, value)
+	
+	def _verify_subtree(self, subtree):
+		""" Logs a warning for every keypath whose value in the database
+		differs from our in-memory document. """
+		found = self.__class__.collection().find_one({"_id": self.id}, dict((kp, 1) for kp in subtree.iterkeys()))
+		for keypath in subtree.iterkeys():
+			stored = _valueAtKeypath(found, keypath)
+			local = _valueAtKeypath(self.doc, keypath)
+			if stored != local:
+				logging.warning("Subtree %s of %s differs after update: %s (database) vs %s (local)" % (keypath, self.id, stored, local))
+	
 	def did_store(self):
 		""" Called after a successful call to "store". """
 		pass
@@ -254,11 +452,21 @@ class MNGObject (object):
 	
 	# -------------------------------------------------------------------------- Multiple
 	@classmethod
-	def retrieve(cls, id_list=[]):
-		""" Retrieves multiple documents by id. """
+	def retrieve(cls, id_list=[], fields=None):
+		""" Retrieves multiple documents by id in one query. The order of the
+		returned objects is undefined.
+		
+		Arguments:
+		fields -- if not None, a list of top-level fields to load, all other
+		          fields will be missing from the objects' documents
+		"""
+		
+		projection = None
+		if fields is not None:
+			projection = dict((fld, 1) for fld in fields)
 		
 		found = []
-		for document in cls.collection().find({"_id": {"$in": id_list}}):
+		for document in cls.collection().find({"_id": {"$in": id_list}}, projection):
 			obj = cls()
 			obj.update_with(document)
 			
@@ -279,6 +487,18 @@ class MNGObject (object):
 
 
 
+class MNGBulkWrites (object):
+	""" Writes queued by one unit of work, see "MNGObject.begin_bulk()". The
+	queue is an ordered dict of pending writes per id, either
+	('save', doc, obj) or ('set', {keypath: value}, obj), and None once the
+	bulk has ended. """
+	
+	def __init__(self, batch_size=500):
+		self.queue = collections.OrderedDict()
+		self.size = max(1, batch_size)
+		self.lock = threading.RLock()
+
+
 def deepUpdate(d, u):
 	""" Deep merges two dictionaries, overwriting "d"s values with "u"s where
 	present. """
@@ -299,6 +519,20 @@ def deepUpdate(d, u):
 	
 	return d
 
+def _keypaths_overlap(one, two):
+	""" True if the keypaths are equal or one contains the other. """
+	return one == two or one.startswith(two + '.') or two.startswith(one + '.')
+
+def _valueAtKeypath(tree, keypath):
+	""" Returns the value at keypath or None. """
+	existing = tree
+	for p in keypath.split('.'):
+		if not isinstance(existing, collections.Mapping):
+			return None
+		existing = existing.get(p)
+	
+	return existing
+
 def deleteSubtree(tree, keypath):
 	""" Deletes the content at keypath. """
 	if not keypath:
@@ -326,6 +560,10 @@ def replaceSubtree(tree, keypath, json):
 	if json is None:
 		return deleteSubtree(tree, keypath)
 	
+	return _setValueAtKeypath(tree, keypath, json)
+
+def _setValueAtKeypath(tree, keypath, value):
+	""" Sets value, even if None, at keypath, creating missing parents. """
 	existing = tree or {}
 	path = keypath.split('.')
 	while len(path) > 1:
@@ -336,9 +574,7 @@ def replaceSubtree(tree, keypath, json):
 			existing = {}
 			previous[p] = existing
 	
-	if existing is None:
-		existing = {}
-	existing[path[0]] = json
+	existing[path[0]] = value
 	
 	return tree
 
@@ -358,6 +594,11 @@ if '__main__' == __name__:
 	print "delete 1", deleteSubtree(a, 'c.ce.cea')
 	print "delete 2", deleteSubtree(a, 'd.da.dda')
 	print
+	print "_setValueAtKeypath()"
+	print "before  ", a
+	print "none 1  ", _setValueAtKeypath(a, 'c.ca', None)
+	print "none 2  ", _setValueAtKeypath(a, 'f.fa.faa', None)
+	print
 	print "deepUpdate(a, b)"
 	print "a: ", a
 	print "b: ", b
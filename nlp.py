@@ -7,7 +7,13 @@
 
 import os
 import re
+import time
+import hashlib
 import logging
+import tempfile
+import threading
+import multiprocessing
+from Queue import Queue, Empty
 
 
 class NLPProcessing (object):
@@ -19,6 +25,13 @@ class NLPProcessing (object):
 		self.root = None
 		self.cleanup = True
 		self.did_prepare = False
+		self.memory_estimate = 512		# MB, used to decide which pipelines can run side by side
+		self.version = '1'				# change to invalidate cached results, e.g. on pipeline upgrades
+		self.cache = None				# NLPCache instance for results by text
+		self._parsed = {}				# parsed output by filename, for inputs shared by several texts
+		self._stream_queue = None
+		self._stream_thread = None
+		self._stream_errors = []
 	
 	
 	# -------------------------------------------------------------------------- Preparations
@@ -47,20 +60,139 @@ class NLPProcessing (object):
 		""" Override to create directories needed to run the pipeline. """
 		pass
 	
+	def prepare_for_worker(self):
+		""" Call in worker processes forked from the process that uses us.
+		They share our settings and prepared directories, but must not touch
+		state belonging to the parent, such as the streaming thread. Subclasses
+		reset their backends and in-memory texts here. """
+		self._stream_queue = None
+		self._stream_thread = None
+		self._stream_errors = []
+		self._parsed = {}
+		if self.cache is not None:
+			self.cache.prepare_for_worker()
+	
 	
 	# -------------------------------------------------------------------------- Running
-	def run(self):
-		""" Runs the NLP pipeline, raises an exception on error. """
+	def run(self, filenames=None):
+		""" Runs the NLP pipeline, raises an exception on error. Pipelines
+		supporting streaming only process the given input files, if any. """
 		if not self.did_prepare:
 			self.prepare()
-		self._run()
+		if not self.streaming:
+			self._parsed = {}
+		self._run(filenames)
 	
-	def _run(self):
+	def _run(self, filenames=None):
 		""" Internal use, subclasses should override this method since it is
 		called after necessary preparation has been performed. """
 		raise Exception("Cannot run an abstract NLP pipeline class instance")
 	
+	# -------------------------------------------------------------------------- Streaming
+	@property
+	def supports_streaming(self):
+		""" True if the pipeline keeps its backend running between runs, so
+		processing small batches as texts come in is cheap. Others would start
+		from scratch for every batch and should run once, on all texts. """
+		return False
+	
+	@property
+	def streaming(self):
+		return self._stream_thread is not None
+	
+	def start_streaming(self, batch_size=50, batch_wait=5):
+		""" Starts a background thread that processes texts passed to
+		"submit()" as they come in: it waits for up to "batch_size" texts or
+		"batch_wait" seconds, runs the pipeline and hands the output to the
+		submitters' callbacks. Only worth it if "supports_streaming" is True.
+		"""
+		if self._stream_thread is not None:
+			return
+		if not self.did_prepare:
+			self.prepare()
+		
+		self._stream_queue = Queue()
+		self._stream_errors = []
+		self._stream_thread = threading.Thread(target=self._stream_worker, args=(batch_size, batch_wait))
+		self._stream_thread.daemon = True
+		self._stream_thread.start()
+	
+	def submit(self, text, filename, callback):
+		""" Writes the text to the input file and queues it for processing.
+		Once processed, "callback" is called with the receiver as its only
+		argument, on the streaming thread; use "parse_output(filename)" to
+		get the result. Returns False if the input could not be written.
+		"""
+		if not self.streaming:
+			raise Exception("Call start_streaming() on %s before submitting texts" % self.name)
+		
+		if not self.write_input(text, filename):
+			return False
+		self._stream_queue.put((filename, callback))
+		return True
+	
+	def finish_streaming(self):
+		""" Waits until all submitted texts have been processed and their
+		callbacks have returned, then stops the background thread. Returns
+		the errors encountered, which have been logged; texts of failed
+		batches are left waiting for the pipeline. """
+		if self._stream_thread is None:
+			return []
+		
+		self._stream_queue.put(None)
+		self._stream_thread.join()
+		self._stream_thread = None
+		self._stream_queue = None
+		self._parsed = {}
+		
+		return self._stream_errors
+	
+	def _stream_worker(self, batch_size, batch_wait):
+		finished = False
+		while not finished:
+			batch = []
+			item = self._stream_queue.get()
+			if item is None:
+				finished = True
+			else:
+				batch.append(item)
+			
+			# collect more items for the batch, but don't wait forever
+			deadline = time.time() + batch_wait
+			while not finished and len(batch) < batch_size:
+				try:
+					item = self._stream_queue.get(timeout=max(0.01, deadline - time.time()))
+				except Empty:
+					break
+				if item is None:
+					finished = True
+				else:
+					batch.append(item)
+			
+			if len(batch) > 0:
+				self._process_stream_batch(batch)
+	
+	def _process_stream_batch(self, batch):
+		try:
+			self.run([filename for filename, callback in batch])
+		except Exception as e:
+			logging.error("Running %s failed: %s" % (self.name, e))
+			self._stream_errors.append(e)
+			return
+		
+		for filename, callback in batch:
+			try:
+				callback(self)
+			except Exception as e:
+				logging.error("Callback for %s output %s failed: %s" % (self.name, filename, e))
+				self._stream_errors.append(e)
+	
+	
+	# -------------------------------------------------------------------------- Input and Output
 	def write_input(self, text, filename):
+		""" Writes the text to the input file, returns True if the text will
+		be processed on the next run. Identical texts use the same filename,
+		in which case the file is only written once. """
 		if not self.did_prepare:
 			self.prepare()
 		
@@ -69,11 +201,71 @@ class NLPProcessing (object):
 	def _write_input(self, text, filename):
 		return False
 	
+	def _write_input_file(self, infile, data):
+		""" Writes the data to a temporary file first and then moves it into
+		place, so that a run never picks up a half-written input file. """
+		fd, tmpfile = tempfile.mkstemp(prefix='.%s-' % self.name, dir=self.root)
+		try:
+			with os.fdopen(fd, 'wb') as handle:
+				handle.write(data)
+			os.rename(tmpfile, infile)
+		except Exception:
+			if os.path.exists(tmpfile):
+				os.remove(tmpfile)
+			raise
+	
 	def parse_output(self, filename, **kwargs):
+		""" Parses the output for the given input file. Results are kept until
+		the next run since the first parse may clean up the files while more
+		texts are waiting for the same output. """
 		if not self.did_prepare:
 			self.prepare()
 		
-		return self._parse_output(filename, **kwargs)
+		key = (filename, frozenset(kwargs.iteritems()))
+		ret = self._parsed.get(key)
+		if ret is None:
+			ret = self._parse_output(filename, **kwargs)
+			if ret is not None:
+				self._parsed[key] = ret
+		
+		return ret
+	
+	def parse_outputs(self, filenames, processes=None, **kwargs):
+		""" Parses the output for all the given input files on a pool of
+		"processes" worker processes (one per CPU if None) and returns a
+		dictionary of filename: result for those that have output. Results
+		are kept like those of "parse_output()", which will find them when
+		called with the same keyword arguments.
+		"""
+		if not self.did_prepare:
+			self.prepare()
+		
+		frozen = frozenset(kwargs.iteritems())
+		parsed = {}
+		todo = []
+		for filename in set(filenames):
+			ret = self._parsed.get((filename, frozen))
+			if ret is not None:
+				parsed[filename] = ret
+			else:
+				todo.append(filename)
+		
+		if len(todo) < 2 or 1 == processes:
+			results = [(filename, self._parse_output(filename, **kwargs)) for filename in todo]
+		else:
+			pool = multiprocessing.Pool(processes, _init_parse_worker, (self, kwargs))
+			try:
+				results = pool.map(_parse_in_worker, todo, 16)
+			finally:
+				pool.close()
+				pool.join()
+		
+		for filename, ret in results:
+			if ret is not None:
+				self._parsed[(filename, frozen)] = ret
+				parsed[filename] = ret
+		
+		return parsed
 	
 	def _parse_output(self, filename, **kwargs):
 		""" return a dictionary (or None) like:
@@ -82,6 +274,22 @@ class NLPProcessing (object):
 		return None
 
 
+_parse_worker_engine = None
+_parse_worker_kwargs = None
+
+def _init_parse_worker(nlp_engine, kwargs):
+	global _parse_worker_engine, _parse_worker_kwargs
+	_parse_worker_engine = nlp_engine
+	_parse_worker_kwargs = kwargs
+
+def _parse_in_worker(filename):
+	try:
+		return filename, _parse_worker_engine._parse_output(filename, **_parse_worker_kwargs)
+	except Exception as e:
+		logging.error("Failed to parse %s output for %s: %s" % (_parse_worker_engine.name, filename, e))
+		return filename, None
+
+
 # ------------------------------------------------------------------------------ Helper Functions
 def split_inclusion_exclusion(string):
 	""" Returns a tuple of lists describing inclusion and exclusion criteria.
@@ -137,6 +345,25 @@ def split_inclusion_exclusion(string):
 	return (inc, exc)
 
 
+def normalized_text(string):
+	""" Collapses all whitespace to single spaces and strips the string, so
+	that texts differing only in formatting are considered the same.
+	"""
+	if string is None:
+		return None
+	
+	return re.sub(r'\s+', ' ', string).strip()
+
+
+def normalized_text_digest(string):
+	""" SHA-1 hex digest of the normalized string. """
+	norm = normalized_text(string)
+	if isinstance(norm, unicode):
+		norm = norm.encode('utf-8')
+	
+	return hashlib.sha1(norm).hexdigest()
+
+
 def list_to_sentences(string):
 	""" Splits text at newlines and puts it back together after stripping new-
 	lines and enumeration symbols, joined by a period.
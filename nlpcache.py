@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#	Caching NLP results by the text they were produced from
+#
+#	2026-10-16	Created
+#
+
+import json
+import hashlib
+
+from sqlitecache import SQLiteCache
+from nlp import normalized_text_digest
+
+
+class NLPCache (SQLiteCache):
+	""" Caches parsed NLP pipeline output in an SQLite database, keyed by a
+	hash of the normalized text and the pipeline's name and version. Many
+	eligibility criteria are word for word the same across trials, those only
+	need to go through the pipeline once.
+	
+	Once more than "max_entries" results are cached, the least recently used
+	ones are evicted.
+	"""
+	
+	table = 'results'
+	columns = 'key VARCHAR PRIMARY KEY, pipeline VARCHAR, result TEXT, accessed INT'
+	
+	def __init__(self, database, max_entries=500000):
+		super(NLPCache, self).__init__(database, max_entries)
+	
+	@staticmethod
+	def key(text, nlp_name, version):
+		""" The key for the given text processed by the given pipeline. """
+		return hashlib.sha1('%s|%s|%s' % (nlp_name, version, normalized_text_digest(text))).hexdigest()
+	
+	
+	# -------------------------------------------------------------------------- Getting and Setting
+	def get(self, text, nlp_name, version):
+		""" Returns the cached result dictionary or None. """
+		key = self.key(text, nlp_name, version)
+		res = self._select(key, ['result'])
+		
+		if res is None:
+			self._did_miss()
+			return None
+		
+		self._did_hit(key, res[1])
+		return json.loads(res[0])
+	
+	def set(self, text, nlp_name, version, result):
+		""" Stores the result dictionary, evicting old entries if needed. """
+		if result is None:
+			return
+		
+		self._insert({
+			'key': self.key(text, nlp_name, version),
+			'pipeline': nlp_name,
+			'result': json.dumps(result),
+		})
+	
+	def invalidate(self, nlp_name=None):
+		""" Removes all results of the given pipeline or, if None, all entries
+		from the cache. """
+		if nlp_name is None:
+			super(NLPCache, self).invalidate()
+		else:
+			sqlite = self.sqlite
+			sqlite.execute('DELETE FROM results WHERE pipeline = ?', (nlp_name,))
+			sqlite.commit()
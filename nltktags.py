@@ -11,9 +11,11 @@ import logging
 import codecs
 import inspect
 import nltk
-import operator
+import threading
+import multiprocessing
 
 from nlp import NLPProcessing, list_to_sentences
+from tagcounter import TagCounter
 
 
 class NLTKTags (NLPProcessing):
@@ -22,6 +24,30 @@ class NLTKTags (NLPProcessing):
 	def __init__(self):
 		super(NLTKTags, self).__init__()
 		self.name = 'nltk-tags'
+		
+		# in-process mode: keep texts in memory instead of writing files and
+		# tag them on a pool of worker processes
+		self.in_process = False
+		self.processes = None			# one per CPU if None
+		self._pending = {}				# text by filename, waiting to be tagged
+		self._pending_lock = threading.Lock()
+		self._tagged = {}				# noun phrases by filename
+		
+		# noun phrase frequencies of the last run; set "top_tags" to only
+		# keep (estimated) counts of that many tags, using bounded memory
+		self.top_tags = None
+		self.tag_counts = None
+	
+	def prepare_for_worker(self):
+		""" Texts held in memory would be lost in a worker, so copies in
+		worker processes hand their texts over through the input directory,
+		which we read in in-process mode as well. """
+		super(NLTKTags, self).prepare_for_worker()
+		self.in_process = False
+		self._pending = {}
+		self._pending_lock = threading.Lock()
+		self._tagged = {}
+		self.tag_counts = None
 	
 	
 	@property
@@ -40,28 +66,20 @@ class NLTKTags (NLPProcessing):
 		if not os.path.exists(out_dir):
 			os.mkdir(out_dir)
 	
-	def _run(self):
+	def _run(self, filenames=None):
+		if self.in_process:
+			self._run_in_process()
+			return
+		
 		in_dir = self._in_dir
 		out_dir = self._out_dir
 		if not os.path.exists(in_dir) or not os.path.exists(out_dir):
 			return
 		
-		# init our simple noun-phrase chunker
-		grammar = r"""
-			NUM:
-				{<CD>}				# "%" is interpreted as NN...
-			
-			NBAR:
-				{<NN.*|JJ>*<NUM>*<NN.*>+}  # Nouns and Adjectives, terminated with Nouns
-			
-			NP:
-				{<NBAR>}			# An NBAR is also a NP
-				{<NBAR><IN><NBAR>}  # Above, connected with in/of/etc...
-		"""
-		chunker = nltk.RegexpParser(grammar)
+		chunker = _nltk_chunker()
 		
 		filelist = os.listdir(in_dir)
-		tag_count = {}
+		tag_count = TagCounter(self.top_tags)
 		i = 0
 		for f in filelist:
 			i = i + 1
@@ -70,30 +88,8 @@ class NLTKTags (NLPProcessing):
 				text = handle.read()
 				
 				# use NLTK to chunk the text
-				chunks = []
-				sentences = nltk.sent_tokenize(text)
-				if sentences and len(sentences) > 0:
-					for sentence in sentences:
-						tokens = nltk.word_tokenize(sentence)
-						tagged = nltk.pos_tag(tokens)
-						tree = chunker.parse(tagged)
-						
-						# get noun phrases
-						np = []
-						for st in _nltk_find_leaves(tree, 'NP'):
-							leaves = st.leaves()
-							if len(leaves) > 0:
-								tag = ' '.join([noun[0] for noun in leaves]).lower()
-								np.append(tag)
-								
-								# count tags
-								if tag in tag_count:
-									tag_count[tag] = tag_count[tag] + 1
-								else:
-									tag_count[tag] = 1
-						
-						if len(np) > 0:
-							chunks.extend(np)
+				chunks = _nltk_noun_phrases(text, chunker)
+				tag_count.update(chunks)
 				
 				# write to outfile
 				if len(chunks) > 0:
@@ -102,11 +98,59 @@ class NLTKTags (NLPProcessing):
 						for chunk in chunks:
 							w_handle.write("%s\n" % unicode(chunk))
 		
-		# tag count
+		self._write_tag_count(tag_count)
+	
+	def _run_in_process(self):
+		""" Tags the texts we hold in memory, and any in the input directory,
+		on a pool of worker processes that load the chunker and tagger once.
+		"""
+		with self._pending_lock:
+			texts = self._pending
+			self._pending = {}
+		
+		# texts written by copies of us in other processes
+		in_dir = self._in_dir
+		if os.path.exists(in_dir):
+			for f in os.listdir(in_dir):
+				if f not in texts:
+					with codecs.open(os.path.join(in_dir, f), 'r', 'utf-8') as handle:
+						texts[f] = handle.read()
+					if self.cleanup:
+						os.remove(os.path.join(in_dir, f))
+		
+		if 0 == len(texts):
+			return
+		
+		# workers tag batches of texts and count their noun phrases
+		items = texts.items()
+		batches = [items[i:i+16] for i in xrange(0, len(items), 16)]
+		tag_count = TagCounter(self.top_tags)
+		
+		if 1 == self.processes or len(items) < 2:
+			_init_nltk_worker()
+			results = (_nltk_tag_items(batch) for batch in batches)
+			pool = None
+		else:
+			pool = multiprocessing.Pool(self.processes, _init_nltk_worker)
+			results = pool.imap_unordered(_nltk_tag_items, batches)
+		
+		try:
+			for tagged, partial_count in results:
+				self._tagged.update(tagged)
+				tag_count.merge(partial_count)
+		finally:
+			if pool is not None:
+				pool.close()
+				pool.join()
+		
+		self._write_tag_count(tag_count)
+	
+	def _write_tag_count(self, tag_count):
+		self.tag_counts = tag_count
 		if len(tag_count) > 0:
-			with codecs.open(os.path.join(out_dir, 'tags.txt'), 'w', 'utf-8') as handle:
-				for tag in sorted(tag_count.iteritems(), key=operator.itemgetter(1), reverse=True):
-					handle.write("%s: %d\n" % (tag[0], int(tag[1])))
+			with codecs.open(os.path.join(self._out_dir, 'tags.txt'), 'w', 'utf-8') as handle:
+				for tag, count in tag_count.most_common():
+					handle.write("%s: %d\n" % (tag, int(count)))
 	
 	
 	def _write_input(self, text, filename):
@@ -115,20 +159,25 @@ class NLTKTags (NLPProcessing):
 			or filename is None:
 			return False
 		
+		# keep in memory
+		if self.in_process:
+			with self._pending_lock:
+				if filename not in self._pending:
+					self._pending[filename] = unicode(list_to_sentences(text))
+			return True
+		
 		in_dir = self._in_dir
 		if not os.path.exists(in_dir):
 			logging.error("The input directory for %s at %s does not exist" % (self.name, in_dir))
 			return False
 		
+		# an identical text has already been written
 		infile = os.path.join(in_dir, filename)
 		if os.path.exists(infile):
-			return False
+			return True
 		
 		# write it
-		with codecs.open(infile, 'w', 'utf-8') as handle:
-			# handle.write(unicode(text))
-			# handle.write("\n=====\n")
-			handle.write(unicode(list_to_sentences(text)))
+		self._write_input_file(infile, unicode(list_to_sentences(text)).encode('utf-8'))
 		
 		return True
 	
@@ -139,7 +188,12 @@ class NLTKTags (NLPProcessing):
 		if filename is None:
 			return None
 		
-		# is there cTAKES output?
+		# tagged in-process
+		chunks = self._tagged.pop(filename, None)
+		if chunks is not None:
+			return {'tags': chunks}
+		
+		# is there output?
 		out_dir = self._out_dir
 		if not os.path.exists(out_dir):
 			logging.error("The output directory for %s at %s does not exist" % (self.name, out_dir))
@@ -176,6 +230,75 @@ class NLTKTags (NLPProcessing):
 		return ret
 
 
+def _nltk_chunker():
+	""" Our simple noun-phrase chunker. """
+	grammar = r"""
+		NUM:
+			{<CD>}				# "%" is interpreted as NN...
+		
+		NBAR:
+			{<NN.*|JJ>*<NUM>*<NN.*>+}  # Nouns and Adjectives, terminated with Nouns
+		
+		NP:
+			{<NBAR>}			# An NBAR is also a NP
+			{<NBAR><IN><NBAR>}  # Above, connected with in/of/etc...
+	"""
+	return nltk.RegexpParser(grammar)
+
+def _nltk_pos_tag_function():
+	""" Returns the tagging function of the tagger "nltk.pos_tag" uses, loaded
+	only once, or "nltk.pos_tag" itself if we can't get to the tagger. """
+	try:
+		return nltk.data.load(nltk.tag._POS_TAGGER).tag
+	except Exception:
+		return nltk.pos_tag
+
+def _nltk_noun_phrases(text, chunker, pos_tag=nltk.pos_tag):
+	""" Returns a list of lowercased noun phrases found in the text. """
+	chunks = []
+	sentences = nltk.sent_tokenize(text)
+	if sentences and len(sentences) > 0:
+		for sentence in sentences:
+			tokens = nltk.word_tokenize(sentence)
+			tagged = pos_tag(tokens)
+			tree = chunker.parse(tagged)
+			
+			# get noun phrases
+			for st in _nltk_find_leaves(tree, 'NP'):
+				leaves = st.leaves()
+				if len(leaves) > 0:
+					chunks.append(' '.join([noun[0] for noun in leaves]).lower())
+	
+	return chunks
+
+_worker_chunker = None
+_worker_pos_tag = None
+
+def _init_nltk_worker():
+	""" Loads the chunker and tagger once per process. """
+	global _worker_chunker, _worker_pos_tag
+	if _worker_chunker is None:
+		_worker_chunker = _nltk_chunker()
+		_worker_pos_tag = _nltk_pos_tag_function()
+
+def _nltk_tag_items(items):
+	""" Takes a list of (filename, text) tuples, returns a dictionary of
+	filename: noun phrases and a dictionary of noun phrase counts. """
+	tagged = {}
+	tag_count = {}
+	for filename, text in items:
+		try:
+			chunks = _nltk_noun_phrases(text, _worker_chunker, _worker_pos_tag)
+		except Exception as e:
+			logging.error("Failed to tag %s: %s" % (filename, e))
+			chunks = []
+		
+		tagged[filename] = chunks
+		for tag in chunks:
+			tag_count[tag] = tag_count.get(tag, 0) + 1
+	
+	return tagged, tag_count
+
 def _nltk_find_leaves(tree, leave_name):
 	try:
 		tree.node
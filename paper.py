@@ -7,9 +7,6 @@
 #
 
 import logging
-import requests
-requests_log = logging.getLogger("requests.packages.urllib3")
-requests_log.setLevel(logging.WARNING)
 from urllib2 import urlopen
 from xml.dom.minidom import parse, parseString
 import os.path
@@ -18,6 +15,7 @@ import tarfile
 import codecs
 
 from dbobject import DBObject
+from httpsession import HTTPSession
 
 
 class Paper (DBObject):
@@ -71,7 +69,7 @@ class Paper (DBObject):
 		
 		# eutils URL
 		url = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/efetch.fcgi?db=pubmed&id=%s&retmode=xml" % self.pmid
-		res = requests.get(url)
+		res = HTTPSession.get(url, cached=True)
 		if not res.ok:
 			logging.warning("%d -- failed to get %s: %s" % (res.status_code, url, res.error))
 		else:
@@ -115,7 +113,7 @@ class Paper (DBObject):
 				links = []
 				
 				url = "http://www.pubmedcentral.nih.gov/utils/oa/oa.fcgi?id=%s" % pmc_id
-				res = requests.get(url)
+				res = HTTPSession.get(url, cached=True)
 				if not res.ok:
 					logging.warning("%d -- failed to get %s: %s" % (res.status_code, url, res.error))
 				else:
@@ -137,9 +135,20 @@ class Paper (DBObject):
 				
 				# download package to file
 				for link in links:
-					req = urlopen(link)
-					with open(filepath, 'wb') as handle:
-						shutil.copyfileobj(req, handle)
+					if 'http' == link[:4]:
+						res = HTTPSession.get(link, stream=True)
+						if not res.ok:
+							logging.warning("%d -- failed to get %s" % (res.status_code, link))
+							continue
+						with open(filepath, 'wb') as handle:
+							for chunk in res.iter_content(64 * 1024):
+								handle.write(chunk)
+					
+					# PMC hands out ftp:// links, which requests can't handle
+					else:
+						req = urlopen(link, timeout=HTTPSession.timeout)
+						with open(filepath, 'wb') as handle:
+							shutil.copyfileobj(req, handle)
 	
 	
 	def parse_pmc_packages(self, run_dir, ctakes_in_dir):
@@ -222,7 +231,7 @@ class Paper (DBObject):
 		
 		# use eutils to find PMIDs
 		url = "http://eutils.ncbi.nlm.nih.gov/entrez/eutils/esearch.fcgi?db=pubmed&term=(%s%%5BTitle%%2FAbstract%%5D)" % nct
-		res = requests.get(url)
+		res = HTTPSession.get(url, cached=True)
 		if not res.ok:
 			logging.warning("%d -- failed to get %s: %s" % (res.status_code, url, res.error))
 		else:
@@ -0,0 +1,219 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#	Importing UMLS and RxNorm RRF files into SQLite
+#
+#	2026-10-16	Created
+#
+#	Usage:	rrfimport.py umls <UMLS install directory> [database]
+#			rrfimport.py rxnorm <RxNorm directory> [database]
+#			rrfimport.py all <UMLS install directory> <RxNorm directory>
+#
+
+import os
+import sys
+import time
+import logging
+import multiprocessing
+
+from sqlite import SQLite
+
+
+# table structure here: http://www.ncbi.nlm.nih.gov/books/NBK9685/
+UMLS_TABLES = [
+	('MRCONSO', ['CUI', 'LAT', 'TS', 'LUI', 'STT', 'SUI', 'ISPREF', 'AUI', 'SAUI', 'SCUI', 'SDUI', 'SAB', 'TTY', 'CODE', 'STR', 'SRL', 'SUPPRESS', 'CVF']),
+	('MRSTY', ['CUI', 'TUI', 'STN', 'STY', 'ATUI', 'CVF']),
+	('MRDEF', ['CUI', 'AUI', 'ATUI', 'SATUI', 'SAB', 'DEF', 'SUPPRESS', 'CVF']),
+]
+
+UMLS_INDEXES = [
+	"CREATE INDEX X_CUI_MRDEF ON MRDEF (CUI)",
+	"CREATE INDEX X_SAB_MRDEF ON MRDEF (SAB)",
+	"CREATE INDEX X_CUI_MRCONSO ON MRCONSO (CUI)",
+	"CREATE INDEX X_LAT_MRCONSO ON MRCONSO (LAT)",
+	"CREATE INDEX X_TS_MRCONSO ON MRCONSO (TS)",
+	"CREATE INDEX X_CUI_MRSTY ON MRSTY (CUI)",
+	"CREATE INDEX X_TUI_MRSTY ON MRSTY (TUI)",
+]
+
+# the faster lookup table, one pass over MRCONSO joined with the grouped
+# semantic types
+UMLS_DESCRIPTIONS = [
+	'''CREATE TABLE descriptions AS
+		SELECT c.CUI, c.LAT, c.SAB, c.TTY, c.STR, s.STY
+		FROM MRCONSO c
+		LEFT JOIN (SELECT CUI, GROUP_CONCAT(TUI, '|') AS STY FROM MRSTY GROUP BY CUI) s
+		ON s.CUI = c.CUI
+		WHERE c.LAT = 'ENG' AND c.TS = 'P' AND c.ISPREF = 'Y'
+	''',
+	"CREATE INDEX X_CUI_desc ON descriptions (CUI)",
+]
+
+# table structure here: http://www.nlm.nih.gov/research/umls/rxnorm/docs/rxnormfiles.html
+RXNORM_TABLES = [
+	('RXNCONSO', ['RXCUI', 'LAT', 'TS', 'LUI', 'STT', 'SUI', 'ISPREF', 'RXAUI', 'SAUI', 'SCUI', 'SDUI', 'SAB', 'TTY', 'CODE', 'STR', 'SRL', 'SUPPRESS', 'CVF']),
+	('RXNREL', ['RXCUI1', 'RXAUI1', 'STYPE1', 'REL', 'RXCUI2', 'RXAUI2', 'STYPE2', 'RELA', 'RUI', 'SRUI', 'SAB', 'SL', 'DIR', 'RG', 'SUPPRESS', 'CVF']),
+	('RXNSAT', ['RXCUI', 'LUI', 'SUI', 'RXAUI', 'STYPE', 'CODE', 'ATUI', 'SATUI', 'ATN', 'SAB', 'ATV', 'SUPPRESS', 'CVF']),
+	('RXNSTY', ['RXCUI', 'TUI', 'STN', 'STY', 'ATUI', 'CVF']),
+]
+
+RXNORM_INDEXES = [
+	"CREATE INDEX X_RXCUI_RXNCONSO ON RXNCONSO (RXCUI)",
+	"CREATE INDEX X_RXCUI1_RXNREL ON RXNREL (RXCUI1)",
+	"CREATE INDEX X_RXCUI2_RXNREL ON RXNREL (RXCUI2)",
+	"CREATE INDEX X_RXCUI_RXNSAT ON RXNSAT (RXCUI)",
+	"CREATE INDEX X_RXCUI_RXNSTY ON RXNSTY (RXCUI)",
+	"CREATE TABLE NDC (RXCUI INT, NDC VARCHAR)",
+	"INSERT INTO NDC SELECT RXCUI, ATV FROM RXNSAT WHERE ATN = 'NDC'",
+	"CREATE INDEX X_RXCUI ON NDC (RXCUI)",
+	"CREATE INDEX X_NDC ON NDC (NDC)",
+]
+
+
+# -------------------------------------------------------------------------- Reading
+def read_rrf(path, num_columns):
+	""" Generator over the rows of an RRF file, decoded to unicode. Lines end
+	in a "|", so splitting produces one empty field at the end which we
+	drop. """
+	with open(path, 'rb') as handle:
+		for i, line in enumerate(handle):
+			row = line.rstrip('\r\n').decode('utf-8').split(u'|')[:-1]
+			if num_columns != len(row):
+				raise Exception("Line %d of %s has %d instead of %d columns" % (i + 1, path, len(row), num_columns))
+			yield row
+
+
+def import_rrf(sqlite, path, table_name, columns, chunk_size=50000):
+	""" Creates the table and inserts all rows of the RRF file in chunks of
+	"chunk_size". Does not commit. Returns the number of rows imported. """
+	logging.info("..>  Importing %s" % table_name)
+	
+	sqlite.execute('CREATE TABLE %s (%s)' % (table_name, ', '.join(['%s TEXT' % c for c in columns])))
+	sql = 'INSERT INTO %s VALUES (%s)' % (table_name, ', '.join(['?'] * len(columns)))
+	start = time.time()
+	num = 0
+	
+	chunk = []
+	for row in read_rrf(path, len(columns)):
+		chunk.append(row)
+		if len(chunk) >= chunk_size:
+			sqlite.executemany(sql, chunk)
+			num += len(chunk)
+			chunk = []
+	
+	if len(chunk) > 0:
+		sqlite.executemany(sql, chunk)
+		num += len(chunk)
+	
+	elapsed = max(time.time() - start, 0.001)
+	logging.info("..>  %d rows imported into %s in %.1f seconds (%d per second)" % (num, table_name, elapsed, num / elapsed))
+	
+	return num
+
+
+def import_rrf_directory(rrf_dir, database, tables, statements):
+	""" Imports the RRF files of all tables from the directory into a new
+	database, then executes the statements (creating indexes and derived
+	tables).
+	
+	The database is built under a temporary name and only moved into place
+	once complete, so an interrupted import does not leave a database behind
+	that looks usable. """
+	if os.path.exists(database):
+		logging.info("=>  %s already exists" % database)
+		return
+	
+	for table_name, columns in tables:
+		path = os.path.join(rrf_dir, '%s.RRF' % table_name)
+		if not os.path.exists(path):
+			raise Exception("The RRF file %s does not exist" % path)
+	
+	tmp_database = '%s.tmp' % database
+	if os.path.exists(tmp_database):
+		os.remove(tmp_database)
+	
+	sqlite = SQLite.get(tmp_database)
+	sqlite.execute('PRAGMA journal_mode = OFF')
+	sqlite.execute('PRAGMA synchronous = OFF')
+	try:
+		for table_name, columns in tables:
+			import_rrf(sqlite, os.path.join(rrf_dir, '%s.RRF' % table_name), table_name, columns)
+			sqlite.commit()
+		
+		logging.info("..>  Creating indexes and lookup tables")
+		for sql in statements:
+			sqlite.execute(sql)
+		sqlite.commit()
+	finally:
+		sqlite.close()
+	
+	os.rename(tmp_database, database)
+	logging.info("=>  Created %s" % database)
+
+
+# -------------------------------------------------------------------------- Importing
+def import_umls(umls_dir, database='databases/umls.db'):
+	""" Imports MRCONSO, MRSTY and MRDEF from the "META" directory of a UMLS
+	install and creates the "descriptions" table our lookups use. """
+	meta_dir = os.path.join(umls_dir, 'META')
+	if not os.path.isdir(meta_dir):
+		raise Exception("There is no directory named META in %s. Download the latest version here: http://www.nlm.nih.gov/research/umls/licensedcontent/umlsknowledgesources.html" % umls_dir)
+	
+	import_rrf_directory(meta_dir, database, UMLS_TABLES, UMLS_INDEXES + UMLS_DESCRIPTIONS)
+
+
+def import_rxnorm(rxnorm_dir, database='databases/rxnorm.db'):
+	""" Imports RXNCONSO, RXNREL, RXNSAT and RXNSTY from the "rrf" directory
+	of an RxNorm release and creates the NDC table. """
+	rrf_dir = os.path.join(rxnorm_dir, 'rrf')
+	if not os.path.isdir(rrf_dir):
+		raise Exception("There is no directory named rrf in %s. Download the latest version here: http://www.nlm.nih.gov/research/umls/rxnorm/docs/rxnormfiles.html" % rxnorm_dir)
+	
+	import_rrf_directory(rrf_dir, database, RXNORM_TABLES, RXNORM_INDEXES)
+
+
+def import_all(umls_dir, rxnorm_dir, directory='databases'):
+	""" Imports UMLS and RxNorm at the same time, one process per database.
+	"""
+	procs = [
+		multiprocessing.Process(target=_import_in_process, args=(import_umls, umls_dir, os.path.join(directory, 'umls.db'))),
+		multiprocessing.Process(target=_import_in_process, args=(import_rxnorm, rxnorm_dir, os.path.join(directory, 'rxnorm.db'))),
+	]
+	for proc in procs:
+		proc.start()
+	for proc in procs:
+		proc.join()
+	
+	if any(0 != proc.exitcode for proc in procs):
+		raise Exception("Importing the databases failed, see the log for details")
+
+
+def _import_in_process(func, source_dir, database):
+	SQLite.discard_instances()
+	try:
+		func(source_dir, database)
+	except Exception as e:
+		logging.error("xx>  %s" % e)
+		sys.exit(1)
+
+
+# run from the "databases" directory (see umls.sh and rxnorm.sh) or give
+# the database path
+if '__main__' == __name__:
+	logging.basicConfig(level=logging.INFO)
+	
+	args = sys.argv[1:]
+	try:
+		if 3 == len(args) and 'all' == args[0]:
+			import_all(args[1], args[2], '.')
+		elif len(args) in (2, 3) and 'umls' == args[0]:
+			import_umls(args[1], args[2] if 3 == len(args) else 'umls.db')
+		elif len(args) in (2, 3) and 'rxnorm' == args[0]:
+			import_rxnorm(args[1], args[2] if 3 == len(args) else 'rxnorm.db')
+		else:
+			print "Usage: %s umls|rxnorm <directory> [database]" % sys.argv[0]
+			print "       %s all <UMLS directory> <RxNorm directory>" % sys.argv[0]
+			sys.exit(1)
+	except Exception as e:
+		print "xx>  %s" % e
+		sys.exit(1)
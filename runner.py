@@ -11,6 +11,10 @@
 
 import os
 import logging
+import threading
+import collections
+import multiprocessing
+import multiprocessing.util
 
 from threading import Thread
 
@@ -48,6 +52,10 @@ class Runner (object):
 		self.catch_exceptions = True		# useful to turn off for debugging
 		
 		self.nlp_pipelines = []
+		self.nlp_concurrency = 1			# number of NLP pipelines allowed to run at the same time
+		self.nlp_memory_budget = None		# MB, limits parallel pipelines by their "memory_estimate"
+		self.streaming_nlp = False			# run NLP while trials come in, in-process codifying only
+		self.nlp_cache = None				# NLPCache for pipelines that don't have their own
 		self.discard_cached = False			# ignore cached codes
 		self.analyze_keypaths = None		# set of keypaths (strings)
 		
@@ -55,6 +63,9 @@ class Runner (object):
 		self.term = None
 		self.reference_location = None		# tuple (latitude, longitude)
 		self.limit = None
+		self.fetch_concurrency = 1			# number of Lilly result pages to fetch in parallel
+		self.mongo_batch_size = 500			# number of trials per bulk write
+		self.num_processes = 1				# > 1 codifies trials on a pool of worker processes
 		
 		self._status = None
 		self._done = False
@@ -91,6 +102,11 @@ class Runner (object):
 			raise Exception("No 'condition' and no 'term' provided")
 		
 		self.assure_run_directory()
+		if self.nlp_cache is not None:
+			for nlp in self.nlp_pipelines:
+				if nlp.cache is None:
+					nlp.cache = self.nlp_cache
+		
 		self.status = "Searching for %s trials..." % (self.condition if self.condition is not None else self.term)
 		
 		# anonymous callback for progress reporting
@@ -109,82 +125,279 @@ class Runner (object):
 		self.status = "Fetching %s trials..." % (self.condition if self.condition is not None else self.term)
 		
 		lilly = LillyCOI()
-		trials = []
+		lilly.concurrency = self.fetch_concurrency
 		if self.condition is not None:
-			trials = lilly.search_for_condition(self.condition, True, fields, cb)
+			found = lilly.iter_search_for_condition(self.condition, True, fields, cb)
 		else:
-			trials = lilly.search_for_term(self.term, True, fields, cb)
-		
-		if self.limit and len(trials) > self.limit:
-			trials = trials[:self.limit]
+			found = lilly.iter_search_for_term(self.term, True, fields, cb)
 		
-		# process found trials
-		self.status = "Processing..."
+		# process found trials while later pages are still being fetched
 		sqlite = SQLite.get(self.sqlite_db)
 		
 		progress = 0
-		progress_tot = len(trials)
-		progress_each = max(5, progress_tot / 25)
+		trials = []
 		ncts = []
 		num_nlp_trials = 0
 		nlp_to_run = set()
-		for trial in trials:
-			ncts.append(trial.nct)
-			trial.analyze_keypaths = self.analyze_keypaths
+		
+		# codify in-process or on a pool of worker processes; Mongo writes are
+		# batched in either case
+		pool = None
+		worker_errors = None
+		stream_failed = []
+		completed = False
+		
+		# only pipelines that keep their backend running are worth streaming
+		streamed = []
+		if self.streaming_nlp:
+			if self.num_processes > 1:
+				logging.warning("Streaming NLP is not available when codifying on multiple processes")
+			else:
+				streamed = [nlp for nlp in self.nlp_pipelines if nlp.supports_streaming]
+				for nlp in self.nlp_pipelines:
+					if nlp not in streamed:
+						logging.info("%s has no persistent backend, running it once all trials are in" % nlp.name)
+		batched = [nlp for nlp in self.nlp_pipelines if nlp not in streamed]
+		
+		if self.num_processes > 1:
+			for nlp in self.nlp_pipelines:
+				if not nlp.did_prepare:
+					nlp.prepare()
+			worker_errors = multiprocessing.Value('i', 0)
+			pool = multiprocessing.Pool(self.num_processes, _init_codify_worker,
+				(self.nlp_pipelines, self.mongo_batch_size, worker_errors))
+			codified = self._codified_trials_parallel(found, trials, pool)
+		else:
+			Trial.begin_bulk(self.mongo_batch_size)
+			codified = self._codified_trials(found, trials)
+			for nlp in streamed:
+				nlp.start_streaming()
+		
+		try:
+			for trial, to_run in codified:
+				ncts.append(trial.nct)
+				self.write_trial(sqlite, trial)
+				
+				# make sure we run the NLP pipeline if needed
+				if len(to_run) > 0:
+					nlp_to_run.update(to_run)
+					num_nlp_trials = num_nlp_trials + 1
+				
+				# progress (we only know the total once the first page is in)
+				progress = progress + 1
+				progress_tot = min(self.limit, lilly.totalCount) if self.limit else lilly.totalCount
+				progress_each = max(5, progress_tot / 25)
+				if 0 == progress % progress_each:
+					self.status = "Processing (%d %%)" % (float(progress) / progress_tot * 100)
 			
-			if self.catch_exceptions:
+			# streaming pipelines have been working all along, wait for the rest
+			if len(streamed) > 0 and num_nlp_trials > 0:
+				self.status = "Waiting for NLP on %d trials..." % num_nlp_trials
+			completed = True
+		except Exception as e:
+			if not self.catch_exceptions:
+				raise
+			self.status = 'Error processing trial: %s' % e
+			return
+		finally:
+			# let workers exit normally to write their pending Mongo batches
+			if pool is not None:
+				if completed:
+					pool.close()
+				else:
+					pool.terminate()
+				pool.join()
+			else:
+				for nlp in streamed:
+					errors = nlp.finish_streaming()
+					if len(errors) > 0:
+						logging.error("%s failed on %d batches, their trials are left waiting for it" % (nlp.name, len(errors)))
+						stream_failed.append((nlp, errors[0]))
 				try:
-					trial.codify_analyzables(self.nlp_pipelines, self.discard_cached)
+					Trial.end_bulk()
 				except Exception as e:
-					self.status = 'Error processing trial: %s' % e
+					if not self.catch_exceptions:
+						raise
+					self.status = 'Error storing trials: %s' % e
 					return
-			else:
-				trial.codify_analyzables(self.nlp_pipelines, self.discard_cached)
+		
+		sqlite.commit()
+		
+		if worker_errors is not None and worker_errors.value > 0:
+			if not self.catch_exceptions:
+				raise Exception("%d worker processes failed to store trials" % worker_errors.value)
+			self.status = 'Error storing trials in %d worker processes' % worker_errors.value
+			return
+		
+		# streamed pipelines that failed count like failed pipeline runs
+		success = True
+		if len(stream_failed) > 0:
+			if not self.catch_exceptions:
+				raise stream_failed[0][1]
+			self.status = '; '.join(["Running %s failed: %s" % (nlp.name, str(e)) for nlp, e in stream_failed])
+			success = False
+		
+		# run the needed NLP pipelines that didn't stream
+		if success:
+			batched_to_run = [nlp for nlp in batched if nlp.name in nlp_to_run]
+			success = self._run_pipelines(batched_to_run, num_nlp_trials)
+		
+		# make sure we codified all criteria, parsing pipeline output up front
+		if success and len(batched) > 0:
+			self._parse_pipeline_outputs(batched_to_run, trials)
 			
+			Trial.begin_bulk(self.mongo_batch_size)
+			try:
+				for trial in trials:
+					trial.codify_analyzables(batched, False)
+			finally:
+				Trial.end_bulk()
+		
+		if success:
+			self.status = 'done'
+		
+		# run the callback
+		if callback is not None:
+			callback(success, trials)
+	
+	
+	def _trials_to_process(self, found, trials):
+		""" Yields found trials up to our limit, collecting them in "trials".
+		"""
+		for trial in found:
+			if self.limit and len(trials) >= self.limit:
+				break
+			trial.analyze_keypaths = self.analyze_keypaths
+			trials.append(trial)
+			yield trial
+	
+	def _codified_trials(self, found, trials):
+		""" Codifies and stores trials one by one, yielding tuples of the trial
+		and the set of NLP pipelines it's waiting for. """
+		for trial in self._trials_to_process(found, trials):
+			trial.codify_analyzables(self.nlp_pipelines, self.discard_cached)
 			trial.store()
-			self.write_trial(sqlite, trial)
 			
-			# make sure we run the NLP pipeline if needed
-			to_run = trial.waiting_for_nlp(self.nlp_pipelines)
-			if len(to_run) > 0:
-				nlp_to_run.update(to_run)
-				num_nlp_trials = num_nlp_trials + 1
+			yield trial, trial.waiting_for_nlp(self.nlp_pipelines)
+	
+	def _codified_trials_parallel(self, found, trials, pool):
+		""" Like "_codified_trials", but the trials are codified and stored by
+		the worker processes of the given pool. Their updated documents are
+		handed back, in order, so we write the "trials" table here.
+		
+		Trials are submitted in a window of a few per process, so "found" is
+		consumed as fast as trials are codified instead of all at once.
+		"""
+		window = 4 * self.num_processes
+		pending = collections.deque()
+		
+		for trial in self._trials_to_process(found, trials):
+			payload = (trial.doc, self.analyze_keypaths, self.discard_cached)
+			pending.append((trial, pool.apply_async(_codify_trial, (payload,))))
 			
-			# progress
-			progress = progress + 1
-			if 0 == progress % progress_each:
-				self.status = "Processing (%d %%)" % (float(progress) / progress_tot * 100)
+			while len(pending) >= window or (len(pending) > 0 and pending[0][1].ready()):
+				yield self._did_codify_in_worker(*pending.popleft())
 		
-		sqlite.commit()
+		while len(pending) > 0:
+			yield self._did_codify_in_worker(*pending.popleft())
+	
+	def _did_codify_in_worker(self, trial, result):
+		doc, to_run = result.get()
+		trial.doc = doc
+		trial.loaded = True
 		
-		# run the needed NLP pipelines
-		success = True
-		for nlp in self.nlp_pipelines:
-			if nlp.name in nlp_to_run:
-				self.status = "Running %s for %d trials (this may take a while)" % (nlp.name, num_nlp_trials)
+		return trial, to_run
+	
+	
+	# -------------------------------------------------------------------------- NLP Pipelines
+	def _parse_pipeline_outputs(self, pipelines, trials):
+		""" Parses the output for our trials' analyzables on "num_processes"
+		processes; the pipelines keep the results so codifying the trials
+		afterwards doesn't need to parse. """
+		if self.num_processes < 2 or len(pipelines) < 1:
+			return
+		
+		filenames = set()
+		for trial in trials:
+			filenames.update(trial.analyzable_nlp_filenames())
+		
+		for nlp in pipelines:
+			self.status = "Parsing %s output..." % nlp.name
+			
+			# use the arguments Analyzable uses when parsing
+			parsed = nlp.parse_outputs(filenames, self.num_processes, filter_sources=True)
+			logging.debug("Parsed %d %s output files" % (len(parsed), nlp.name))
+	
+	def _run_pipelines(self, pipelines, num_trials):
+		""" Runs the given NLP pipelines, one after the other or, if
+		"nlp_concurrency" is greater than one, up to that many at a time and
+		only as many as fit into "nlp_memory_budget" (if set). Returns True
+		if all pipelines succeeded.
+		"""
+		if len(pipelines) < 1:
+			return True
+		
+		if self.nlp_concurrency < 2 or len(pipelines) < 2:
+			for nlp in pipelines:
+				self.status = "Running %s for %d trials (this may take a while)" % (nlp.name, num_trials)
 				if self.catch_exceptions:
 					try:
 						nlp.run()
 					except Exception as e:
 						self.status = "Running %s failed: %s" % (nlp.name, str(e))
-						success = False
-						break
+						return False
 				else:
 					nlp.run()
-		
-		# make sure we codified all criteria
-		if success:
-			for trial in trials:
-				trial.codify_analyzables(self.nlp_pipelines, False)
+			return True
+		
+		# run in parallel
+		names = ', '.join([nlp.name for nlp in pipelines])
+		self.status = "Running %s for %d trials (this may take a while)" % (names, num_trials)
+		
+		cond = threading.Condition()
+		running = {}				# pipeline name: memory estimate
+		failed = []
+		
+		def run(nlp):
+			try:
+				nlp.run()
+			except Exception as e:
+				failed.append((nlp, e))
+			finally:
+				with cond:
+					del running[nlp.name]
+					cond.notify_all()
+		
+		threads = []
+		for nlp in pipelines:
+			with cond:
+				while len(running) > 0 and not self._may_start_pipeline(nlp, running):
+					cond.wait()
+				running[nlp.name] = nlp.memory_estimate
 			
-			self.status = 'done'
+			thread = Thread(target=run, args=(nlp,))
+			thread.start()
+			threads.append(thread)
 		
-		# run the callback
-		if callback is not None:
-			callback(success, trials)
-
-
-	# -------------------------------------------------------------------------- NLP Pipelines
+		for thread in threads:
+			thread.join()
+		
+		if len(failed) > 0:
+			if not self.catch_exceptions:
+				raise failed[0][1]
+			self.status = '; '.join(["Running %s failed: %s" % (nlp.name, str(e)) for nlp, e in failed])
+			return False
+		
+		return True
+	
+	def _may_start_pipeline(self, nlp, running):
+		""" Whether the pipeline fits next to the running ones. """
+		if len(running) >= self.nlp_concurrency:
+			return False
+		if self.nlp_memory_budget is not None:
+			return sum(running.values()) + nlp.memory_estimate <= self.nlp_memory_budget
+		return True
+	
 	def add_pipeline(self, nlp_pipeline):
 		""" Add an NLP pipeline to the runner. """
 		
@@ -239,7 +452,10 @@ class Runner (object):
 	
 	
 	# -------------------------------------------------------------------------- Results
-	def overview(self, restrict='reason'):
+	def overview(self, restrict='reason', offset=0, limit=None):
+		""" Returns the number of trials per intervention type and per (drug)
+		phase. Use "offset" and "limit" to only count a page of trials, in
+		distance order. """
 		if not self.done:
 			raise Exception("Trial results are not yet available")
 		
@@ -250,11 +466,9 @@ class Runner (object):
 		# collect intervention types and (drug) trial phases
 		types = {}
 		phases = {}
-		qry = "SELECT types, phases FROM trials WHERE run_id = ?"
-		if 'reason' == restrict:
-			qry += ' AND reason IS NULL'
+		qry, params = self._trials_query('types, phases', restrict, offset=offset, limit=limit)
 		
-		for row in sqlite.execute(qry, (self.run_id,)):
+		for row in sqlite.execute(qry, params):
 			if row[0]:
 				for tp in row[0].split('|'):
 					types[tp] = types[tp] + 1 if tp in types else 1
@@ -268,9 +482,10 @@ class Runner (object):
 			'drug_phases': phases
 		}
 	
-	def trial_phases(self, restrict='reason', filter_interventions=None):
+	def trial_phases(self, restrict='reason', filter_interventions=None, offset=0, limit=None):
 		""" Return a dict with the number of trials per phase after filtering
-		by intervention type. """
+		by intervention type. Use "offset" and "limit" to only count a page of
+		trials, in distance order. """
 		if not self.done:
 			raise Exception("Trial results are not yet available")
 		
@@ -280,30 +495,37 @@ class Runner (object):
 		
 		# collect (drug) trial phases
 		phases = {}
-		qry = "SELECT phases FROM trials WHERE run_id = ?"
-		
-		if 'reason' == restrict:
-			qry += ' AND reason IS NULL'
-		
-		# filter by interventions
-		if filter_interventions is not None:
-			ored = []
-			for inter in filter_interventions:
-				ored.append('types LIKE "%%%s%%"' % inter)
-			if len(ored) > 0:
-				qry = qry + ' AND (' + ' OR '.join(ored) + ')'
+		qry, params = self._trials_query('phases', restrict, filter_interventions, offset=offset, limit=limit)
 		
 		# execute query
-		for row in sqlite.execute(qry, (self.run_id,)):
+		for row in sqlite.execute(qry, params):
 			if row[0]:
 				for ph in row[0].split('|'):
 					phases[ph] = phases[ph] + 1 if ph in phases else 1
 		
 		return phases
 	
-	def trials_json(self, restrict='reason', filter_interventions=None, filter_phases=None):
+	def num_trials(self, restrict='reason', filter_interventions=None, filter_phases=None):
+		""" Returns the number of matching trials, useful to paginate
+		"trials_json". """
+		if not self.done:
+			raise Exception("Trial results are not yet available")
+		
+		sqlite = SQLite.get(self.sqlite_db)
+		if sqlite is None:
+			raise Exception("No SQLite handle, please set up properly")
+		
+		qry, params = self._trials_query('COUNT(*)', restrict, filter_interventions, filter_phases, order=False)
+		return sqlite.executeOne(qry, params)[0]
+	
+	def trials_json(self, restrict='reason', filter_interventions=None, filter_phases=None, offset=0, limit=None, fields=None):
 		""" Returns an array of trial JSON for the matching trials, optionally
 		filtered by intervention type and/or drug phases.
+		
+		Arguments:
+		offset, limit -- return only this page of trials, ordered by distance
+		fields -- the extra trial fields to include in the JSON, defaults to
+		          keyword, phase and overall_contact. Only these are loaded.
 		"""
 		if not self.done:
 			raise Exception("Trial results are not yet available")
@@ -312,19 +534,59 @@ class Runner (object):
 		if sqlite is None:
 			raise Exception("No SQLite handle, please set up properly")
 		
-		# look up trials. Currently cheaply filtering by string comparison
-		qry = "SELECT nct FROM trials WHERE run_id = ? AND reason IS NULL"
+		# look up trials (we never return those with a reason)
+		qry, params = self._trials_query('nct', 'reason', filter_interventions, filter_phases, offset=offset, limit=limit)
+		
+		if fields is None:
+			fields = ['keyword', 'phase', 'overall_contact']
+		lat = float(self.reference_location[0]) if self.reference_location else 0
+		lng = float(self.reference_location[1]) if self.reference_location else 0
+		
+		# retrieve ncts
+		ncts = [row[0] for row in sqlite.execute(qry, params)]
+		
+		# grab trial data in batch from db, only the fields that we need, and
+		# restore distance order
+		projection = ['official_title', 'brief_title', 'acronym'] + fields
+		if lat and lng:
+			projection.append('location')
+		by_nct = {}
+		for trial in Trial.retrieve(ncts, projection):
+			by_nct[trial.nct] = trial
+		
+		trials = []
+		for nct in ncts:
+			trial = by_nct.get(nct)
+			if trial is None:
+				trial = Trial(nct)
+				trial.loaded = True			# not in db, don't try again
+			trial_dict = trial.json(fields)
+			
+			# add trial locations
+			if lat and lng:
+				closest = []
+				for loc in trial.locations_closest_to(lat, lng, open_only=True):
+					closest.append(loc[0].json())
+				trial_dict['location'] = closest
+			
+			trials.append(trial_dict)
+		
+		return trials
+	
+	def _trials_query(self, columns, restrict='reason', filter_interventions=None, filter_phases=None, order=True, offset=0, limit=None):
+		""" Composes the SELECT query on our "trials" table for the given
+		columns and returns it along with its parameters. Currently cheaply
+		filtering by string comparison. """
+		qry = "SELECT %s FROM trials WHERE run_id = ?" % columns
+		params = [self.run_id]
 		
 		if 'reason' == restrict:
 			qry += ' AND reason IS NULL'
 		
-		tpls = [self.run_id]
 		if filter_interventions is not None:
 			ored = []
 			for inter in filter_interventions:
 				ored.append('types LIKE "%%%s%%"' % inter)
-				# ored.append('instr(types, ?)')
-				# tpls.append(inter)
 			if len(ored) > 0:
 				qry = qry + ' AND (' + ' OR '.join(ored) + ')'
 		
@@ -332,40 +594,19 @@ class Runner (object):
 			ored = []
 			for phase in filter_phases:
 				ored.append('phases LIKE "%%%s%%"' % phase)
-				# ored.append('instr(phases, ?)')
-				# tpls.append(phase)
-			
 			if len(ored) > 0:
 				qry = qry + ' AND (' + ' OR '.join(ored) + ')'
 		
-		trials = []
-		fields = ['keyword', 'phase', 'overall_contact']
-		lat = float(self.reference_location[0]) if self.reference_location else 0
-		lng = float(self.reference_location[1]) if self.reference_location else 0
+		# order and paginate; nct makes the order stable for equal distances
+		if order:
+			qry += ' ORDER BY distance ASC, nct ASC'
+		if limit is not None or offset > 0:
+			qry += ' LIMIT ? OFFSET ?'
+			params.extend([limit if limit is not None else -1, offset])
 		
-		# retrieve ncts
-		qry += ' ORDER BY distance ASC'
-		for row in sqlite.execute(qry, tuple(tpls)):
-			trial = Trial(row[0])
-			trial.load()
-			trial_dict = trial.json(fields)
-			
-			# add trial locations
-			if lat and lng:
-				closest = []
-				for loc in trial.locations_closest_to(lat, lng, open_only=True):
-					closest.append(loc[0].json())
-				trial_dict['location'] = closest
-			
-			trials.append(trial_dict)
-		
-		# grab trial data in batch from db - PROBLEM: distance order is not preserved
-		# for trial in Trial.retrieve(ncts):
-		# 	trials.append(trial.json(fields))
-		
-		return trials
-
-
+		return qry, tuple(params)
+	
+	
 	def write_trial(self, sqlite, trial):
 		""" Stores metadata about the given trial pertaining to the current run.
 		"""
@@ -454,6 +695,7 @@ class Runner (object):
 			UNIQUE (run_id, nct) ON CONFLICT REPLACE,
 			FOREIGN KEY (run_id) REFERENCES runs (run_id) ON DELETE CASCADE
 		)''')
+		sqlite.execute('CREATE INDEX IF NOT EXISTS trials_distance_index ON trials (run_id, distance)')
 		
 		stat_query = "INSERT OR IGNORE INTO runs (run_id, status) VALUES (?, ?)"
 		sqlite.executeInsert(stat_query, (self.run_id, 'initializing'))
@@ -463,3 +705,47 @@ class Runner (object):
 		sqlite.execute(clean_qry, ())
 		sqlite.commit()
 
+
+# ------------------------------------------------------------------------------ Worker Processes
+_worker_pipelines = None
+_worker_errors = None
+
+def _init_codify_worker(nlp_pipelines, mongo_batch_size, errors):
+	""" Worker processes must not use the database connections inherited from
+	their parent. The NLP pipelines are handed over once, here, by forking
+	rather than pickling, so they drop their parent's state explicitly, and
+	Mongo writes are batched until the worker exits. """
+	global _worker_pipelines, _worker_errors
+	SQLite.discard_instances()
+	Trial.discard_collection()
+	
+	for nlp in nlp_pipelines:
+		nlp.prepare_for_worker()
+	_worker_pipelines = nlp_pipelines
+	_worker_errors = errors
+	Trial.begin_bulk(mongo_batch_size)
+	multiprocessing.util.Finalize(None, _end_codify_worker, exitpriority=10)
+
+def _end_codify_worker():
+	""" Writes the remaining batch, counting failures for the parent. """
+	try:
+		Trial.end_bulk()
+	except Exception as e:
+		logging.error("Failed to store trials: %s" % e)
+		with _worker_errors.get_lock():
+			_worker_errors.value += 1
+
+def _codify_trial(payload):
+	""" Codifies and stores one trial in a worker process and returns its
+	updated document and the set of NLP pipelines it's waiting for. """
+	doc, analyze_keypaths, discard_cached = payload
+	
+	trial = Trial(doc.get('_id') or doc.get('id'))
+	trial.doc = doc
+	trial.loaded = True
+	trial.analyze_keypaths = analyze_keypaths
+	trial.codify_analyzables(_worker_pipelines, discard_cached)
+	trial.store()
+	
+	return trial.doc, trial.waiting_for_nlp(_worker_pipelines)
+
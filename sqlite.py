@@ -51,6 +51,15 @@ class SQLite (object):
 		return by_thread[database]
 	
 	
+	@classmethod
+	def discard_instances(cls):
+		""" Forgets all instances without closing their connections, needed in
+		forked child processes which must not use their parent's connections.
+		"""
+		global SQLITE_INSTANCES
+		SQLITE_INSTANCES = {}
+	
+	
 	def __init__(self, database=None):
 		if database is None:
 			raise Exception('No database provided')
@@ -73,6 +82,19 @@ class SQLite (object):
 		return self.cursor.execute(sql, params)
 
 
+	def executemany(self, sql, seq_of_params):
+		""" Executes an SQL command against all parameter tuples in the
+		sequence (or iterator) and returns the cursor. Much faster than
+		calling "execute()" for each row when inserting in bulk.
+		"""
+		if not sql or len(sql) < 1:
+			raise Exception('No SQL to execute')
+		if not self.cursor:
+			self.connect()
+		
+		return self.cursor.executemany(sql, seq_of_params)
+
+
 	def executeInsert(self, sql, params=()):
 		""" Executes an SQL command (should be INSERT OR REPLACE) and returns
 		the last row id, 0 on failure.
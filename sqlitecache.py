@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#	Least recently used caches in SQLite
+#
+#	2026-10-16	Created
+#
+
+import time
+import logging
+import threading
+
+from sqlite import SQLite
+
+
+class CacheStatistics (object):
+	""" Counts cache hits and misses. Subclasses count under "_lock". """
+	
+	def __init__(self):
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+	
+	def stats(self):
+		""" Returns a dictionary with hits, misses and the hit ratio. """
+		total = self.hits + self.misses
+		return {
+			'hits': self.hits,
+			'misses': self.misses,
+			'ratio': float(self.hits) / total if total > 0 else 0.0
+		}
+
+
+class SQLiteCache (CacheStatistics):
+	""" Abstract base for caches keeping one row per key in an SQLite table.
+	
+	Subclasses set "table", "key_column" and "columns", the column
+	definitions, which must include "accessed INT". Once the sum of
+	"weight_column" over all rows, or their number if it's None, exceeds
+	"capacity", the least recently used rows are evicted. The access time is
+	refreshed at most every "touch_interval" seconds so reading doesn't
+	write on every hit.
+	"""
+	
+	table = None
+	key_column = 'key'
+	columns = None
+	weight_column = None
+	touch_interval = 600
+	
+	def __init__(self, database, capacity):
+		if database is None:
+			raise Exception('No database provided')
+		
+		super(SQLiteCache, self).__init__()
+		self.database = database
+		self.capacity = capacity
+		self._did_setup = False
+	
+	def prepare_for_worker(self):
+		""" Call in forked worker processes, the lock may have been held by
+		another thread of the parent. """
+		self._lock = threading.Lock()
+		self.hits = 0
+		self.misses = 0
+	
+	@property
+	def sqlite(self):
+		""" SQLite handles are per thread, so always ask for it. """
+		sqlite = SQLite.get(self.database)
+		if not self._did_setup:
+			sqlite.create(self.table, '(%s)' % self.columns)
+			sqlite.execute("CREATE INDEX IF NOT EXISTS accessed_index ON %s (accessed)" % self.table)
+			sqlite.commit()
+			self._did_setup = True
+		
+		return sqlite
+	
+	
+	# -------------------------------------------------------------------------- Getting and Setting
+	def _select(self, key, columns):
+		""" Returns the given columns of the row for the key, followed by its
+		access time, or None. Use "_did_hit()" or "_did_miss()" afterwards. """
+		return self.sqlite.executeOne('SELECT %s, accessed FROM %s WHERE %s = ?' % (', '.join(columns), self.table, self.key_column), (key,))
+	
+	def _did_hit(self, key, accessed):
+		""" Counts a hit, refreshing the access time if it's due. """
+		now = int(time.time())
+		if accessed < now - self.touch_interval:
+			sqlite = self.sqlite
+			sqlite.execute('UPDATE %s SET accessed = ? WHERE %s = ?' % (self.table, self.key_column), (now, key))
+			sqlite.commit()
+		with self._lock:
+			self.hits += 1
+	
+	def _did_miss(self):
+		with self._lock:
+			self.misses += 1
+	
+	def _insert(self, values):
+		""" Inserts or replaces the row with the given column values, setting
+		its access time, and evicts old rows if needed. """
+		values = dict(values)
+		values['accessed'] = int(time.time())
+		columns = values.keys()
+		
+		sqlite = self.sqlite
+		sqlite.execute('INSERT OR REPLACE INTO %s (%s) VALUES (%s)' % (self.table, ', '.join(columns), ', '.join(['?'] * len(columns))),
+			[values[c] for c in columns])
+		self._evict(sqlite)
+		sqlite.commit()
+	
+	def _evict(self, sqlite):
+		""" Deletes least recently used rows once we're above capacity, down to
+		90% of it so we don't do this on every insert. """
+		weight = self.weight_column or '1'
+		total = sqlite.executeOne('SELECT SUM(%s) FROM %s' % (weight, self.table), ())[0] or 0
+		if total <= self.capacity:
+			return
+		
+		target = int(self.capacity * 0.9)
+		evict = []
+		for row in sqlite.execute('SELECT %s, %s FROM %s ORDER BY accessed ASC' % (self.key_column, weight, self.table)):
+			evict.append((row[0],))
+			total -= row[1]
+			if total <= target:
+				break
+		
+		sqlite.executemany('DELETE FROM %s WHERE %s = ?' % (self.table, self.key_column), evict)
+		logging.debug("Evicted %d entries from the cache in %s" % (len(evict), self.database))
+	
+	def invalidate(self, key=None):
+		""" Removes the entry for the given key or, if None, all entries from
+		the cache. """
+		sqlite = self.sqlite
+		if key is None:
+			sqlite.execute('DELETE FROM %s' % self.table)
+		else:
+			sqlite.execute('DELETE FROM %s WHERE %s = ?' % (self.table, self.key_column), (key,))
+		sqlite.commit()
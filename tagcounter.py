@@ -0,0 +1,148 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+#	Counting tag frequencies
+#
+#	2026-10-16	Created
+#
+
+import heapq
+import struct
+import hashlib
+from array import array
+
+
+class TagCounter (object):
+	""" Counts how often tags occur.
+	
+	By default counts are exact and kept in a dictionary. With "top_k" set,
+	memory is bounded: counts are kept in a count-min sketch of "depth" rows
+	of "width" counters, and only the "top_k" most frequent tags are
+	remembered. Counts are then estimates that may be too high, but never
+	too low.
+	
+	Partial counts, for example from worker processes, can be combined with
+	"merge()".
+	"""
+	
+	def __init__(self, top_k=None, width=2**18, depth=4):
+		if depth > 4:
+			raise Exception("A depth of at most 4 is supported")
+		
+		self.top_k = top_k
+		self.width = width
+		self.depth = depth
+		self.total = 0
+		
+		if top_k is None:
+			self._counts = {}
+		else:
+			self._sketch = [array('l', [0]) * width for i in range(depth)]
+			self._top = {}			# estimated count by tag
+			self._heap = []			# (count, tag), may contain outdated entries
+	
+	@property
+	def bounded(self):
+		return self.top_k is not None
+	
+	
+	# -------------------------------------------------------------------------- Counting
+	def add(self, tag, count=1):
+		""" Adds "count" occurrences of the tag. """
+		self.total += count
+		if not self.bounded:
+			self._counts[tag] = self._counts.get(tag, 0) + count
+			return
+		
+		estimate = None
+		for row, idx in zip(self._sketch, self._indexes(tag)):
+			row[idx] += count
+			estimate = row[idx] if estimate is None else min(estimate, row[idx])
+		self._offer(tag, estimate)
+	
+	def update(self, tags):
+		""" Adds one occurrence of every tag in the iterable. """
+		for tag in tags:
+			self.add(tag)
+	
+	def merge(self, other):
+		""" Adds the counts of another TagCounter or of a dictionary of tag:
+		count. Bounded counters can only merge counters of the same size. """
+		if isinstance(other, dict):
+			for tag, count in other.iteritems():
+				self.add(tag, count)
+			return
+		
+		if not other.bounded:
+			self.merge(other._counts)
+			return
+		
+		if not self.bounded or self.width != other.width or self.depth != other.depth:
+			raise Exception("Can only merge bounded tag counters with the same width and depth")
+		
+		self.total += other.total
+		for row, other_row in zip(self._sketch, other._sketch):
+			for idx, count in enumerate(other_row):
+				if count:
+					row[idx] += count
+		
+		# counts of our top tags have changed, as may have the top tags
+		candidates = set(self._top.keys()) | set(other._top.keys())
+		self._top = {}
+		self._heap = []
+		for tag in candidates:
+			self._offer(tag, self.count(tag))
+	
+	def count(self, tag):
+		""" The (estimated) number of occurrences of the tag. """
+		if not self.bounded:
+			return self._counts.get(tag, 0)
+		return min(row[idx] for row, idx in zip(self._sketch, self._indexes(tag)))
+	
+	def most_common(self, n=None):
+		""" A list of (tag, count) tuples, most frequent first; all we know of
+		if "n" is None. Bounded counters know of "top_k" tags at most. """
+		counts = self._counts if not self.bounded else self._top
+		if n is None:
+			return sorted(counts.iteritems(), key=lambda item: item[1], reverse=True)
+		return heapq.nlargest(n, counts.iteritems(), key=lambda item: item[1])
+	
+	def __len__(self):
+		return len(self._counts if not self.bounded else self._top)
+	
+	
+	# -------------------------------------------------------------------------- Sketch
+	def _indexes(self, tag):
+		""" One counter index per row, stable across processes so sketches
+		can be merged. """
+		if isinstance(tag, unicode):
+			tag = tag.encode('utf-8')
+		hashes = struct.unpack('<4I', hashlib.md5(tag).digest())
+		return [h % self.width for h in hashes[:self.depth]]
+	
+	def _offer(self, tag, estimate):
+		""" Keeps the tag if it's among the "top_k" most frequent. """
+		if tag in self._top or len(self._top) < self.top_k:
+			self._top[tag] = estimate
+			heapq.heappush(self._heap, (estimate, tag))
+		else:
+			low, low_tag = self._lowest()
+			if estimate <= low:
+				return
+			heapq.heappop(self._heap)
+			del self._top[low_tag]
+			self._top[tag] = estimate
+			heapq.heappush(self._heap, (estimate, tag))
+		
+		# drop outdated heap entries every now and then
+		if len(self._heap) > 4 * self.top_k:
+			self._heap = [(count, tag) for tag, count in self._top.iteritems()]
+			heapq.heapify(self._heap)
+	
+	def _lowest(self):
+		""" The current entry of the least frequent top tag. """
+		while True:
+			low, low_tag = self._heap[0]
+			if self._top.get(low_tag) == low:
+				return low, low_tag
+			heapq.heappop(self._heap)
@@ -343,12 +343,26 @@ class Trial (MNGObject):
 		else:
 			analyzable = self._analyzables[keypath]
 		
-		# codify (if needed) and store
-		newly_stored = analyzable.codify(nlp_pipelines, force)
+		# codify (if needed) and store; streamed results are stored in the
+		# bulk writes of this thread, if any
+		bulk = self.__class__.current_bulk()
+		callback = lambda analyzable, nlp_name: self._did_codify_analyzable(analyzable, nlp_name, bulk)
+		newly_stored = analyzable.codify(nlp_pipelines, force, callback)
 		if newly_stored:
 			for nlp, content in newly_stored.iteritems():
 				self.store_codified_property(keypath, content, nlp)
 	
+	def _did_codify_analyzable(self, analyzable, nlp_name, bulk=None):
+		""" Called by streaming NLP pipelines, on their thread. """
+		cls = self.__class__
+		if bulk is not None:
+			cls.join_bulk(bulk)
+		try:
+			self.store_codified_property(analyzable.keypath, analyzable.codified.get(nlp_name), nlp_name)
+		finally:
+			if bulk is not None:
+				cls.leave_bulk()
+	
 	def codify_analyzables(self, nlp_pipelines, force=False):
 		""" Codifies all analyzables that the receiver knows about. """
 		if self.analyze_keypaths is None:
@@ -357,6 +371,22 @@ class Trial (MNGObject):
 		for keypath in self.analyze_keypaths:
 			self._codify_analyzable(keypath, nlp_pipelines, force)
 	
+	def analyzable_nlp_filenames(self):
+		""" The NLP input and output filenames for our analyzables' texts. """
+		if self.analyze_keypaths is None:
+			return set()
+		
+		filenames = set()
+		for keypath in self.analyze_keypaths:
+			analyzable = self._analyzables.get(keypath) if self._analyzables else None
+			if analyzable is None:
+				analyzable = Analyzable(self, keypath)
+			text = analyzable.extract_string()
+			if text:
+				filenames.add(analyzable.nlp_filename(text))
+		
+		return filenames
+	
 	def analyzable_results(self):
 		""" Returns codified results for our analyzables, with the following
 		hierarchy:
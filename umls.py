@@ -9,10 +9,14 @@
 
 import csv
 import sys
+import time
 import os.path
 import logging
+import collections
 
 from sqlite import SQLite
+from codeindex import CodeIndex
+from sqlitecache import CacheStatistics
 
 
 class UMLS (object):
@@ -25,7 +29,7 @@ class UMLS (object):
 		Will raise on errors!
 		
 		UMLS: (umls.db)
-		If missing prompt to use the `umls.sh` script
+		If missing prompt to use the `umls.sh` script (or `rrfimport.py`)
 		
 		SNOMED: (snomed.db)
 		Read SNOMED CT from tab-separated files and create an SQLite database.
@@ -34,19 +38,19 @@ class UMLS (object):
 		# UMLS
 		umls_db = os.path.join('databases', 'umls.db')
 		if not os.path.exists(umls_db):
-			raise("The UMLS database at %s does not exist. Run the import script `databases/umls.sh`." % umls_db)
+			raise Exception("The UMLS database at %s does not exist. Run the import script `databases/umls.sh` or `rrfimport.py umls`." % umls_db)
 		
 		# SNOMED
 		SNOMED.sqlite_handle = None
 		try:
 			SNOMED.setup_tables()
 		except Exception as e:
-			raise("SNOMED setup failed: %s" % e)
+			raise Exception("SNOMED setup failed: %s" % e)
 		
 		# RxNorm
 		rxnorm_db = os.path.join('databases', 'rxnorm.db')
 		if not os.path.exists(rxnorm_db):
-			raise("The RxNorm database at %s does not exist. Run the import script `databases/rxnorm.sh`." % rxnorm_db)
+			raise Exception("The RxNorm database at %s does not exist. Run the import script `databases/rxnorm.sh` or `rrfimport.py rxnorm`." % rxnorm_db)
 		
 		else:
 			rx_map = {
@@ -63,9 +67,141 @@ class UMLS (object):
 				
 				snomed_file = os.path.join('databases', filename)
 				if not os.path.exists(snomed_file):
-					raise("Need to import SNOMED, but the file %s is not present. Download SNOMED from http://www.nlm.nih.gov/research/umls/licensedcontent/snomedctfiles.html" % filename)
+					raise Exception("Need to import SNOMED, but the file %s is not present. Download SNOMED from http://www.nlm.nih.gov/research/umls/licensedcontent/snomedctfiles.html" % filename)
 				
 				SNOMED.import_csv_into_table(snomed_file, table)
+			
+			SNOMED.create_indexes()
+	
+	@classmethod
+	def build_lookup_indexes(cls, directory='databases'):
+		""" Exports the names our lookup classes report from the UMLS, SNOMED
+		and RxNorm databases into compact index files ("umls.idx",
+		"snomed.idx" and "rxnorm.idx"), which the lookups use instead of the
+		databases when present. Only preferred names are exported, lookups
+		for non-preferred names still use the databases.
+		"""
+		
+		# UMLS: CUI -> [(STR, SAB, STY), ...] of preferred sources
+		umls_db = os.path.join(directory, 'umls.db')
+		if os.path.exists(umls_db):
+			sql = 'SELECT CAST(CUI AS TEXT) AS cui, STR, SAB, STY FROM descriptions WHERE SAB IN (%s) ORDER BY cui, rowid' % ", ".join(UMLSLookup.preferred_sources)
+			rows = SQLite.get(umls_db).execute(sql)
+			num = CodeIndex.build(os.path.join(directory, 'umls.idx'), _grouped_rows(rows))
+			logging.info("Indexed %d UMLS concepts" % num)
+		
+		# SNOMED: concept id -> [(term, isa, active), ...]
+		snomed_db = os.path.join(directory, 'snomed.db')
+		if os.path.exists(snomed_db):
+			sql = 'SELECT CAST(concept_id AS TEXT) AS concept, term, isa, active FROM descriptions ORDER BY concept, rowid'
+			rows = SQLite.get(snomed_db).execute(sql)
+			num = CodeIndex.build(os.path.join(directory, 'snomed.idx'), _grouped_rows(rows))
+			logging.info("Indexed %d SNOMED concepts" % num)
+		
+		# RxNorm: RXCUI -> the best (STR, TTY, RXAUI)
+		rxnorm_db = os.path.join(directory, 'rxnorm.db')
+		if os.path.exists(rxnorm_db):
+			sql = 'SELECT CAST(RXCUI AS TEXT) AS rxcui, STR, TTY, RXAUI FROM RXNCONSO WHERE LAT = "ENG" ORDER BY rxcui, rowid'
+			rows = SQLite.get(rxnorm_db).execute(sql)
+			best = ((rxcui, RxNormLookup._preferred_row(found)) for rxcui, found in _grouped_rows(rows))
+			num = CodeIndex.build(os.path.join(directory, 'rxnorm.idx'), best)
+			logging.info("Indexed %d RxNorm concepts" % num)
+		
+		# lookups should pick up the new indexes
+		_indexes.clear()
+		lookup_cache.invalidate()
+
+
+
+class LookupCache (CacheStatistics):
+	""" A bounded, thread-safe LRU cache for code lookups. One instance,
+	"lookup_cache", is shared by all our lookup classes since reports look
+	up the same codes over and over again.
+	"""
+	
+	def __init__(self, max_size=100000):
+		super(LookupCache, self).__init__()
+		self.max_size = max_size
+		self._items = collections.OrderedDict()
+	
+	def get(self, key, default=None):
+		""" Returns the value cached for the key, or "default". """
+		with self._lock:
+			try:
+				value = self._items.pop(key)
+			except KeyError:
+				self.misses += 1
+				return default
+			
+			self._items[key] = value		# most recently used now
+			self.hits += 1
+			return value
+	
+	def set(self, key, value):
+		with self._lock:
+			self._items.pop(key, None)
+			self._items[key] = value
+			while len(self._items) > self.max_size:
+				self._items.popitem(last=False)
+	
+	def invalidate(self, namespace=None):
+		""" Removes all entries or, if given, only those whose key tuple's
+		first element is "namespace", such as "snomed". """
+		with self._lock:
+			if namespace is None:
+				self._items.clear()
+			else:
+				for key in [k for k in self._items.iterkeys() if namespace == k[0]]:
+					del self._items[key]
+	
+	def stats(self):
+		""" Returns a dictionary with size, hits, misses and the hit ratio. """
+		stats = super(LookupCache, self).stats()
+		stats['size'] = len(self._items)
+		return stats
+
+lookup_cache = LookupCache()
+_not_cached = object()
+
+# codes per "IN (...)" query, SQLite allows 999 variables by default
+_in_chunk_size = 500
+
+def _chunked(items, size):
+	for i in xrange(0, len(items), size):
+		yield items[i:i+size]
+
+def _grouped_rows(rows):
+	""" Groups rows sorted by their first column, yields tuples of the first
+	column and a list of the rows' remaining columns. """
+	key = None
+	group = []
+	for row in rows:
+		if row[0] != key:
+			if len(group) > 0:
+				yield key, group
+			key = row[0]
+			group = []
+		group.append(tuple(row[1:]))
+	
+	if len(group) > 0:
+		yield key, group
+
+# index files by path, None if there is none; see "UMLS.build_lookup_indexes()"
+_indexes = {}
+
+def _lookup_index(path):
+	""" Returns the CodeIndex at path, or None if there is no index file or if
+	it is older than its database, it would answer with stale names. """
+	if path not in _indexes:
+		index = None
+		if os.path.exists(path):
+			database = '%s.db' % os.path.splitext(path)[0]
+			if os.path.exists(database) and os.path.getmtime(database) > os.path.getmtime(path):
+				logging.warning("Not using %s, it is older than %s. Run `UMLS.build_lookup_indexes()` to update it." % (path, database))
+			else:
+				index = CodeIndex(path)
+		_indexes[path] = index
+	return _indexes[path]
 
 
 
@@ -75,10 +211,23 @@ class UMLSLookup (object):
 	sqlite_handle = None
 	did_check_dbs = False
 	preferred_sources = ['"SNOMEDCT"', '"MTH"']	
+	cache = lookup_cache
+	index_path = 'databases/umls.idx'
 	
 	def __init__(self):
 		self.sqlite = SQLite.get('databases/umls.db')
 	
+	@classmethod
+	def _check_databases(cls):
+		""" Lazy UMLS db checking. """
+		if not UMLSLookup.did_check_dbs:
+			UMLSLookup.did_check_dbs = True
+			try:
+				UMLS.check_databases()
+			except Exception as e:
+				logging.error(e)
+				# should this crash and burn?
+	
 	def lookup_code(self, cui, preferred=True):
 		""" Return a list with triples that contain:
 		- name
@@ -93,41 +242,65 @@ class UMLSLookup (object):
 		if cui is None or len(cui) < 1:
 			return []
 		
-		# lazy UMLS db checking
-		if not UMLSLookup.did_check_dbs:
-			UMLSLookup.did_check_dbs = True
-			try:
-				UMLS.check_databases()
-			except Exception as e:
-				logging.error(e)
-				# should this crash and burn?
+		return self.lookup_codes([cui], preferred).get(cui, [])
+	
+	def lookup_codes(self, cuis, preferred=True):
+		""" Like "lookup_code" for an iterable of CUIs, which are looked up
+		in chunks of 500. Returns a dictionary of CUI: list of triples.
+		"""
+		self._check_databases()
 		
-		# take care of negations
-		negated = '-' == cui[0]
-		if negated:
-			cui = cui[1:]
+		found = {}
+		missing = {}			# requested CUIs by (lookup CUI, negated)
+		for cui in set(cuis):
+			if cui is None or len(cui) < 1:
+				continue
+			
+			# take care of negations
+			negated = '-' == cui[0]
+			lookup_cui = (cui[1:] if negated else cui).split('@', 1)[0]
+			
+			arr = self.cache.get(('umls', lookup_cui, negated, preferred), _not_cached)
+			if arr is not _not_cached:
+				found[cui] = list(arr)
+			else:
+				missing.setdefault((lookup_cui, negated), []).append(cui)
 		
-		parts = cui.split('@', 1)
-		lookup_cui = parts[0]
+		if len(missing) < 1:
+			return found
 		
 		# STR: Name
 		# SAB: Abbreviated Source Name
 		# STY: Semantic Type
 		if preferred:
-			sql = 'SELECT STR, SAB, STY FROM descriptions WHERE CUI = ? AND SAB IN (%s)' % ", ".join(UMLSLookup.preferred_sources)
+			sql = 'SELECT CUI, STR, SAB, STY FROM descriptions WHERE CUI IN (%%s) AND SAB IN (%s)' % ", ".join(UMLSLookup.preferred_sources)
 		else:
-			sql = 'SELECT STR, SAB, STY FROM descriptions WHERE CUI = ?'
+			sql = 'SELECT CUI, STR, SAB, STY FROM descriptions WHERE CUI IN (%s)'
 		
-		# return as list
-		arr = []
-		for res in self.sqlite.execute(sql, (lookup_cui,)):
-			if negated:
-				arr.append(("[NEGATED] %s" % res[0], res[1], res[2]))
-			else:
-				arr.append(res)
+		rows = {}
+		lookup_cuis = list(set(lookup_cui for lookup_cui, negated in missing))
+		index = _lookup_index(self.index_path) if preferred else None
+		if index is not None:
+			for lookup_cui, results in index.get_many(lookup_cuis).iteritems():
+				rows[lookup_cui] = [tuple(res) for res in results]
+		else:
+			for chunk in _chunked(lookup_cuis, _in_chunk_size):
+				for res in self.sqlite.execute(sql % ', '.join(['?'] * len(chunk)), tuple(chunk)):
+					rows.setdefault(res[0], []).append(res[1:])
 		
-		return arr
+		for (lookup_cui, negated), requested in missing.iteritems():
+			arr = []
+			for res in rows.get(lookup_cui, []):
+				if negated:
+					arr.append(("[NEGATED] %s" % res[0], res[1], res[2]))
+				else:
+					arr.append(res)
+			
+			self.cache.set(('umls', lookup_cui, negated, preferred), arr)
+			for cui in requested:
+				found[cui] = list(arr)
 		
+		return found
 	
 	def lookup_code_meaning(self, cui, preferred=True, no_html=True):
 		""" Return a string (an empty string if the cui is null or not found)
@@ -137,15 +310,41 @@ class UMLSLookup (object):
 		our "descriptions" table is much faster than combing through the full
 		MRCONSO table.
 		"""
-		names = []
-		for res in self.lookup_code(cui, preferred):
-			if no_html:
-				names.append("%s (%s)  [%s]" % (res[0], res[1], res[2]))
+		if cui is None or len(cui) < 1:
+			return ''
+		
+		return self.lookup_code_meanings([cui], preferred, no_html).get(cui, '')
+	
+	def lookup_code_meanings(self, cuis, preferred=True, no_html=True):
+		""" Like "lookup_code_meaning" for an iterable of CUIs, returns a
+		dictionary of CUI: meaning. """
+		meanings = {}
+		missing = []
+		for cui in set(cuis):
+			if cui is None or len(cui) < 1:
+				continue
+			
+			# the position suffix doesn't change the meaning
+			meaning = self.cache.get(('umls', 'meaning', cui.split('@', 1)[0], preferred, no_html))
+			if meaning is not None:
+				meanings[cui] = meaning
 			else:
-				names.append("%s (<span style=\"color:#090;\">%s</span>: %s)" % (res[0], res[1], res[2]))
+				missing.append(cui)
+		
+		for cui, results in self.lookup_codes(missing, preferred).iteritems():
+			names = []
+			for res in results:
+				if no_html:
+					names.append("%s (%s)  [%s]" % (res[0], res[1], res[2]))
+				else:
+					names.append("%s (<span style=\"color:#090;\">%s</span>: %s)" % (res[0], res[1], res[2]))
+			
+			comp = ", " if no_html else "<br/>\n"
+			meaning = comp.join(names) if len(names) > 0 else ''
+			self.cache.set(('umls', 'meaning', cui.split('@', 1)[0], preferred, no_html), meaning)
+			meanings[cui] = meaning
 		
-		comp = ", " if no_html else "<br/>\n"
-		return comp.join(names) if len(names) > 0 else ''
+		return meanings
 
 	
 
@@ -154,41 +353,68 @@ class SNOMED (object):
 	
 	# -------------------------------------------------------------------------- Database Setup
 	@classmethod
-	def import_csv_into_table(cls, snomed_file, table_name):
+	def import_csv_into_table(cls, snomed_file, table_name, chunk_size=50000):
 		""" Import SNOMED CSV into our SQLite database.
 		The SNOMED CSV files can be parsed by Python's CSV parser with the
 		"excel-tab" flavor.
+		Rows are inserted "chunk_size" at a time in one transaction, with
+		journaling and syncing turned off while loading. Call
+		"create_indexes()" once all tables have been imported.
 		"""
 		
 		logging.debug('..>  Importing SNOMED %s into snomed.db...' % table_name)
 		
+		sqlite = cls.sqlite_handle
+		sql = cls.insert_query_for(table_name)
+		start = time.time()
+		num = 0
+		line = 0
+		
 		# not yet imported, parse tab-separated file and import
-		with open(snomed_file, 'rb') as csv_handle:
-			cls.sqlite_handle.isolation_level = 'EXCLUSIVE'
-			sql = cls.insert_query_for(table_name)
-			reader = unicode_csv_reader(csv_handle, dialect='excel-tab')
-			i = 0
-			try:
-				for row in reader:
-					if i > 0:			# first row is the header row
+		sqlite.execute('PRAGMA journal_mode = OFF')
+		sqlite.execute('PRAGMA synchronous = OFF')
+		try:
+			with open(snomed_file, 'rb') as csv_handle:
+				reader = unicode_csv_reader(csv_handle, dialect='excel-tab')
+				chunk = []
+				try:
+					for row in reader:
+						line += 1
+						if line > 1:			# first row is the header row
+							chunk.append(cls.insert_tuple_from_csv_row_for(table_name, row))
 						
 						# execute SQL (we just ignore duplicates)
-						params = cls.insert_tuple_from_csv_row_for(table_name, row)
-						try:
-							cls.sqlite_handle.execute(sql, params)
-						except Exception as e:
-							sys.exit(u'Cannot insert %s: %s' % (params, e))
-					i += 1
+						if len(chunk) >= chunk_size:
+							cls._insert_chunk(sql, chunk, num)
+							num += len(chunk)
+							chunk = []
+					
+					if len(chunk) > 0:
+						cls._insert_chunk(sql, chunk, num)
+						num += len(chunk)
 				
-				# commit to file
-				cls.sqlite_handle.commit()
-				cls.did_import(table_name)
-				cls.sqlite_handle.isolation_level = None
+				except csv.Error as e:
+					sys.exit('CSV error on line %d: %s' % (line, e))
 			
-			except csv.Error as e:
-				sys.exit('CSV error on line %d: %s' % (reader.line_num, e))
-
-		logging.debug('..>  %d concepts parsed' % (i-1))
+			# commit to file
+			sqlite.commit()
+			cls.did_import(table_name)
+			sqlite.commit()
+			lookup_cache.invalidate('snomed')
+			_indexes.pop(SNOMEDLookup.index_path, None)
+		finally:
+			sqlite.execute('PRAGMA synchronous = FULL')
+			sqlite.execute('PRAGMA journal_mode = DELETE')
+		
+		elapsed = max(time.time() - start, 0.001)
+		logging.debug('..>  %d concepts parsed in %.1f seconds (%d per second)' % (num, elapsed, num / elapsed))
+	
+	@classmethod
+	def _insert_chunk(cls, sql, chunk, num_before):
+		try:
+			cls.sqlite_handle.executemany(sql, chunk)
+		except Exception as e:
+			sys.exit(u'Cannot insert rows %d to %d: %s' % (num_before + 1, num_before + len(chunk), e))
 
 
 	@classmethod
@@ -206,7 +432,6 @@ class SNOMED (object):
 				isa VARCHAR,
 				active INT
 			)''')
-		cls.sqlite_handle.execute("CREATE INDEX IF NOT EXISTS isa_index ON descriptions (isa)")
 		
 		# relationships
 		cls.sqlite_handle.create('relationships', '''(
@@ -217,11 +442,22 @@ class SNOMED (object):
 				rel_text VARCHAR,
 				active INT
 			)''')
+	
+	@classmethod
+	def create_indexes(cls):
+		""" Creates our indexes, if they don't exist yet. Do this after
+		importing, maintaining them while inserting rows is much slower.
+		"""
+		if cls.sqlite_handle is None:
+			cls.sqlite_handle = SQLite.get('databases/snomed.db')
+		
+		cls.sqlite_handle.execute("CREATE INDEX IF NOT EXISTS isa_index ON descriptions (isa)")
 		cls.sqlite_handle.execute("CREATE INDEX IF NOT EXISTS source_index ON relationships (source_id)")
 		cls.sqlite_handle.execute("CREATE INDEX IF NOT EXISTS destination_index ON relationships (destination_id)")
 		cls.sqlite_handle.execute("CREATE INDEX IF NOT EXISTS rel_type_index ON relationships (rel_type)")
 		cls.sqlite_handle.execute("CREATE INDEX IF NOT EXISTS rel_text_index ON relationships (rel_text)")
-		
+		cls.sqlite_handle.commit()
+	
 	
 	@classmethod
 	def insert_query_for(cls, table_name):
@@ -273,6 +509,8 @@ class SNOMEDLookup (object):
 	""" SNOMED lookup """
 	
 	sqlite_handle = None
+	cache = lookup_cache
+	index_path = 'databases/snomed.idx'
 	
 	
 	def __init__(self):
@@ -285,19 +523,58 @@ class SNOMEDLookup (object):
 		if snomed_id is None or len(snomed_id) < 1:
 			return ''
 		
-		sql = 'SELECT term, isa, active FROM descriptions WHERE concept_id = ?'
-		names = []
+		return self.lookup_code_meanings([snomed_id], preferred, no_html).get(snomed_id, '')
+	
+	def lookup_code_meanings(self, snomed_ids, preferred=True, no_html=True):
+		""" Like "lookup_code_meaning" for an iterable of SNOMED ids, which are
+		looked up in chunks of 500. Returns a dictionary of id: meaning.
+		"""
+		meanings = {}
+		missing = set()
+		for snomed_id in set(snomed_ids):
+			if snomed_id is None or len(snomed_id) < 1:
+				continue
+			
+			meaning = self.cache.get(('snomed', snomed_id, no_html))
+			if meaning is not None:
+				meanings[snomed_id] = meaning
+			else:
+				missing.add(snomed_id)
+		
+		if len(missing) < 1:
+			return meanings
+		
+		# collect (concept id, term, isa, active); ids come back as integers
+		rows = []
+		index = _lookup_index(self.index_path)
+		if index is not None:
+			for snomed_id, results in index.get_many(missing).iteritems():
+				rows.extend([snomed_id] + res for res in results)
+		else:
+			sql = 'SELECT concept_id, term, isa, active FROM descriptions WHERE concept_id IN (%s)'
+			for chunk in _chunked(list(missing), _in_chunk_size):
+				rows.extend(self.sqlite.execute(sql % ', '.join(['?'] * len(chunk)), tuple(chunk)))
 		
 		# loop over results
-		for res in self.sqlite.execute(sql, (snomed_id,)):
-			if not no_html and ('synonym' == res[1] or 0 == res[2]):
-				names.append("<span style=\"color:#888;\">%s</span>" % res[0])
+		names = {}
+		for res in rows:
+			if not no_html and ('synonym' == res[2] or 0 == res[3]):
+				name = "<span style=\"color:#888;\">%s</span>" % res[1]
 			else:
-				names.append(res[0])
+				name = res[1]
+			names.setdefault(unicode(res[0]), []).append(name)
 		
-		if no_html:
-			return ", ".join(names) if len(names) > 0 else ''
-		return "<br/>\n".join(names) if len(names) > 0 else ''
+		for snomed_id in missing:
+			found = names.get(unicode(snomed_id), [])
+			if no_html:
+				meaning = ", ".join(found) if len(found) > 0 else ''
+			else:
+				meaning = "<br/>\n".join(found) if len(found) > 0 else ''
+			
+			self.cache.set(('snomed', snomed_id, no_html), meaning)
+			meanings[snomed_id] = meaning
+		
+		return meanings
 
 
 
@@ -305,6 +582,8 @@ class RxNormLookup (object):
 	""" RxNorm lookup """
 	
 	sqlite_handle = None
+	cache = lookup_cache
+	index_path = 'databases/rxnorm.idx'
 	
 	
 	def __init__(self):
@@ -317,32 +596,58 @@ class RxNormLookup (object):
 		if rx_id is None or len(rx_id) < 1:
 			return ''
 		
-		# retrieve all matches
-		sql = 'SELECT STR, TTY, RXAUI FROM RXNCONSO WHERE RXCUI = ? AND LAT = "ENG"'
-		found = []
+		return self.lookup_code_meanings([rx_id], preferred, no_html).get(rx_id, '')
+	
+	def lookup_code_meanings(self, rx_ids, preferred=True, no_html=True):
+		""" Like "lookup_code_meaning" for an iterable of RxNorm ids, which are
+		looked up in chunks of 500. Returns a dictionary of id: meaning.
+		"""
+		meanings = {}
+		missing = set()
+		for rx_id in set(rx_ids):
+			if rx_id is None or len(rx_id) < 1:
+				continue
+			
+			# "no_html" is not used here
+			meaning = self.cache.get(('rxnorm', rx_id, preferred))
+			if meaning is not None:
+				meanings[rx_id] = meaning
+			else:
+				missing.add(rx_id)
+		
+		if len(missing) < 1:
+			return meanings
+		
+		# retrieve all matches; the index only has the preferred one
+		found = {}
+		index = _lookup_index(self.index_path) if preferred else None
+		if index is not None:
+			for rx_id, res in index.get_many(missing).iteritems():
+				found[unicode(rx_id)] = [tuple(res)]
+		else:
+			sql = 'SELECT RXCUI, STR, TTY, RXAUI FROM RXNCONSO WHERE RXCUI IN (%s) AND LAT = "ENG"'
+			for chunk in _chunked(list(missing), _in_chunk_size):
+				for res in self.sqlite.execute(sql % ', '.join(['?'] * len(chunk)), tuple(chunk)):
+					found.setdefault(unicode(res[0]), []).append(res[1:])
+		
+		for rx_id in missing:
+			meaning = self._meaning_from(found.get(unicode(rx_id), []), preferred)
+			self.cache.set(('rxnorm', rx_id, preferred), meaning)
+			meanings[rx_id] = meaning
+		
+		return meanings
+	
+	def _meaning_from(self, found, preferred):
+		""" HTML for the (STR, TTY, RXAUI) tuples found for one code. """
 		names = []
 		format_str = "<span title=\"RXAUI: %s\">%s <span style=\"color:#888;\">[%s]</span></span>"
 		
-		# loop over them
-		for res in self.sqlite.execute(sql, (rx_id,)):
-			found.append(res)
-		
 		if len(found) > 0:
 			
 			# preferred name only
 			if preferred:
-				for tty in ['BN', 'IN', 'PIN', 'SBDC', 'SCDC', 'SBD', 'SCD', 'MIN']:
-					for res in found:
-						if tty == res[1]:
-							names.append(format_str % (res[2], res[0], res[1]))
-							break
-					else:
-						continue
-					break
-				
-				if len(names) < 1:
-					res = found[0]
-					names.append(format_str % (res[2], res[0], res[1]))
+				res = self._preferred_row(found)
+				names.append(format_str % (res[2], res[0], res[1]))
 			
 			# return a list of all names
 			else:
@@ -351,6 +656,17 @@ class RxNormLookup (object):
 		
 		return "<br/>\n".join(names) if len(names) > 0 else ''
 	
+	@staticmethod
+	def _preferred_row(found):
+		""" The (STR, TTY, RXAUI) tuple with the "best" TTY, the first one if
+		none has one of the TTYs we prefer. """
+		for tty in ['BN', 'IN', 'PIN', 'SBDC', 'SCDC', 'SBD', 'SCD', 'MIN']:
+			for res in found:
+				if tty == res[1]:
+					return res
+		
+		return found[0]
+	
 
 
 # the standard Python CSV reader can't do unicode, here's the workaround